@@ -0,0 +1,208 @@
+# The code in this file backtests HedgeHog's stock picking on historical data. It works
+# fully offline, from the statements already downloaded in the statement cache and
+# from a local price history file, and never calls any API. The statements of the
+# whole universe are laid out in a (tickers x fiscal years) panel, so that every ratio
+# of every ticker and year is calculated at once by the column functions of quant.py.
+# At each rebalance date, every company is scored on the annual reports it had
+# published by then, on the same fiscal year as the pipeline (the one before the
+# latest, see quant.pick_year), the companies above the median are bought, weighted by
+# their score like in main.py, and held until the next rebalance date.
+# Since Gemeni cannot tell how a company was perceived in the past, the backtest only
+# uses the quantitative scores.
+#
+# The statements can also be read from the fundamentals store (see store.py), which
+# is much faster to load than the cached JSON responses for a large universe.
+#
+# The price history is a CSV file with a 'date' column (YYYY-MM-DD) followed by one
+# column of closing prices per ticker.
+
+import csv
+import argparse
+import numpy as np
+from cache import filing_lag, DAY
+from quant import statement_cache, ratio_columns
+from scorecalc import params_table, score_matrix, average_scores, load_score_params
+from statements import FinancialStatements, UniversePanel, all_fields
+from store import FundamentalsStore
+from tickers import sp500
+
+# Metrics the backtest scores companies on, the same ones as main.py
+default_metrics = ['liabilities_to_equity', 'liabilities_to_capital', 'assets_to_equity', 'debt_to_ebitda',
+                   'quick_ratio', 'current_ratio', 'ten_yr_opex_growth', 'ten_yr_assets_growth',
+                   'ten_yr_liabilities_growth']
+
+# Fiscal year the pipeline scores, counted back from the latest report (see quant.pick_year)
+scored_year = 1
+
+def load_cached_statements(tickers : list):
+    """Builds the FinancialStatements of every ticker whose balance sheet and income
+       statement are in the statement cache, however old they are. Never calls the API.
+       Tickers whose cached statements have no annual reports, or malformed ones (e.g.
+       an income statement with quarterly reports only), are left out."""
+    statements_list = []
+
+    for ticker in tickers:
+        balance_sheet = statement_cache.load(ticker, 'BALANCE_SHEET')
+        income_statement = statement_cache.load(ticker, 'INCOME_STATEMENT')
+
+        if balance_sheet is None or income_statement is None:
+            continue
+
+        try:
+            statements = FinancialStatements.from_reports(balance_sheet['data'], income_statement['data'])
+        except (KeyError, ValueError, TypeError):
+            continue
+
+        statements.ticker = ticker
+        statements_list.append(statements)
+
+    return statements_list
+
+def panel_subset(panel : UniversePanel, tickers : list):
+    """Returns the rows of a panel for the given tickers (those it has), as a copy."""
+    wanted = set(tickers)
+    rows = [row for row, ticker in enumerate(panel.tickers) if ticker in wanted]
+
+    subset = UniversePanel()
+    subset.tickers = [panel.tickers[row] for row in rows]
+    subset.years = panel.years
+    subset.fiscal_ends = panel.fiscal_ends[rows]
+    for field in all_fields:
+        setattr(subset, field, getattr(panel, field)[rows])
+
+    return subset
+
+def load_prices(path : str):
+    """Reads a price history CSV file. Returns the sorted dates, the tickers and a
+       (dates x tickers) array of closing prices, NaN where there is none."""
+    with open(path, newline='') as price_file:
+        rows = list(csv.reader(price_file))
+
+    tickers = rows[0][1:]
+    rows = sorted(rows[1:], key=lambda row: row[0])
+    dates = np.array([row[0] for row in rows], dtype='datetime64[D]')
+    prices = np.array([[float(value) if value else np.nan for value in row[1:]] for row in rows], dtype=float).reshape(len(rows), len(tickers))
+
+    return dates, tickers, prices
+
+def point_in_time_ratios(panel : UniversePanel, metrics : list, rebalance_dates : np.ndarray, year : int = 0):
+    """Returns a (dates x tickers x metrics) array of the ratios of every company as
+       they could be calculated at each rebalance date, from the latest annual report
+       published by then (a report is assumed published filing_lag after its fiscal
+       year ends), or from the one year fiscal years before it. NaN where a company had
+       no such report yet or a ratio fails."""
+    ratio_panels = np.stack([ratio_columns[metric](panel) for metric in metrics], axis=-1)
+
+    published = panel.fiscal_ends + np.timedelta64(int(filing_lag // DAY), 'D')
+    available = published[None, :, :] <= rebalance_dates[:, None, None]
+
+    # Columns are sorted most recent first, so the first available one is the latest
+    columns = available.argmax(axis=2) + year
+    ratios = ratio_panels[np.arange(len(panel.tickers))[None, :], np.minimum(columns, ratio_panels.shape[1] - 1)]
+    ratios[~available.any(axis=2) | (columns >= ratio_panels.shape[1])] = np.nan
+
+    return ratios
+
+def select_portfolios(averages : np.ndarray):
+    """Applies the selection of main.py to every row of a (dates x tickers) array of
+       average scores: the top half of the scored companies is bought, each with a
+       weight proportional to its score. Returns the (dates x tickers) weights. Any
+       leading axes (e.g. one per parameter set, see calibrate.py) are kept."""
+    valid = ~np.isnan(averages)
+    valid_count = valid.sum(axis=-1, keepdims=True)
+
+    # Rank of every company among the scored ones of its row, unscored ones ranking last
+    ranks = np.argsort(np.argsort(np.where(valid, averages, -np.inf), axis=-1, kind='stable'), axis=-1)
+    ranks -= averages.shape[-1] - valid_count
+
+    selected = valid & (ranks >= valid_count // 2)
+    weights = np.where(selected, averages, 0)
+    totals = weights.sum(axis=-1, keepdims=True)
+
+    return np.divide(weights, totals, out=np.zeros_like(weights), where=totals > 0)
+
+def stock_returns(rebalance_dates : np.ndarray, tickers : list, price_dates : np.ndarray, price_tickers : list,
+                  prices : np.ndarray):
+    """Returns the (periods x tickers) return of every stock between each rebalance
+       date and the next one, using the last closing price at or before each date.
+       NaN where a stock has no price."""
+    columns = {ticker: column for column, ticker in enumerate(price_tickers)}
+    aligned = np.full((len(price_dates), len(tickers)), np.nan)
+    for index, ticker in enumerate(tickers):
+        if ticker in columns:
+            aligned[:, index] = prices[:, columns[ticker]]
+
+    rows = np.searchsorted(price_dates, rebalance_dates, side='right') - 1
+    at_dates = np.where((rows >= 0)[:, None], aligned[np.maximum(rows, 0)], np.nan)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return at_dates[1:] / at_dates[:-1] - 1
+
+def weighted_returns(weights : np.ndarray, returns : np.ndarray):
+    """Returns the return of each portfolio of a (dates x tickers) weight array over
+       the following period, from the stock_returns. Picks without prices over a
+       period are left out and the weights of the others renormalized. Any leading
+       axes of weights are kept."""
+    held = weights[..., :-1, :] * ~np.isnan(returns)
+    totals = held.sum(axis=-1)
+    gains = np.where(held > 0, held * np.nan_to_num(returns), 0).sum(axis=-1)
+
+    return np.divide(gains, totals, out=np.zeros_like(gains), where=totals > 0)
+
+def portfolio_returns(weights : np.ndarray, rebalance_dates : np.ndarray, tickers : list, price_dates : np.ndarray,
+                      price_tickers : list, prices : np.ndarray):
+    """Returns the return of each portfolio between its rebalance date and the next
+       one (see stock_returns and weighted_returns)."""
+    return weighted_returns(weights, stock_returns(rebalance_dates, tickers, price_dates, price_tickers, prices))
+
+def default_rebalance_dates(price_dates : np.ndarray):
+    """Returns every April 1st covered by a price history, once most annual reports
+       of the previous year are out."""
+    first_year = price_dates[0].astype(object).year
+    last_year = price_dates[-1].astype(object).year
+    return np.array([f'{year}-04-01' for year in range(first_year, last_year + 1)], dtype='datetime64[D]')
+
+def run_backtest(tickers : list, price_path : str, rebalance_dates : list = None, metrics : list = default_metrics,
+                 store_path : str = None, score_params_path : str = 'score_params.json'):
+    """Backtests the stock picking over a universe of tickers. rebalance_dates are
+       'YYYY-MM-DD' strings, every April 1st covered by the price history by default.
+       With store_path, the statements are read from that fundamentals store, and the
+       whole store is backtested when tickers is None. The companies are scored on the
+       parameters of score_params_path if there is such a file. Returns a dictionary with the
+       dates, the tickers, the (dates x tickers) weights, the return of each holding
+       period and the cumulative return."""
+    if store_path is not None:
+        panel = FundamentalsStore(store_path).panel()
+        if tickers is not None:
+            panel = panel_subset(panel, tickers)
+    else:
+        panel = UniversePanel.from_statements(load_cached_statements(tickers))
+    price_dates, price_tickers, prices = load_prices(price_path)
+
+    dates = default_rebalance_dates(price_dates) if rebalance_dates is None else np.array(rebalance_dates, dtype='datetime64[D]')
+
+    load_score_params(score_params_path)
+    stds, means = params_table(metrics)
+    scores = score_matrix(point_in_time_ratios(panel, metrics, dates, scored_year), stds, means)
+    weights = select_portfolios(average_scores(scores))
+    returns = portfolio_returns(weights, dates, panel.tickers, price_dates, price_tickers, prices)
+
+    return {'dates': dates, 'tickers': panel.tickers, 'weights': weights,
+            'returns': returns, 'cumulative': float(np.prod(1 + returns) - 1)}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtests HedgeHog offline, from cached statements and a price history CSV file.')
+    parser.add_argument('prices', help='price history CSV file (a date column, then one column per ticker)')
+    parser.add_argument('--tickers', nargs='+', default=sp500, help='universe to backtest (S&P 500 by default)')
+    parser.add_argument('--dates', nargs='+', help='rebalance dates as YYYY-MM-DD (every April 1st by default)')
+    parser.add_argument('--store', help='read the statements from this fundamentals store rather than the statement cache')
+    parser.add_argument('--params', default='score_params.json', help='distribution parameter file to score on, if it exists (see calibrate.py)')
+    args = parser.parse_args()
+
+    results = run_backtest(args.tickers, args.prices, args.dates, store_path=args.store, score_params_path=args.params)
+
+    print(f'Backtested {len(results["tickers"])} companies over {len(results["dates"])} rebalance dates')
+    for index, date in enumerate(results['dates'][:-1]):
+        picks = np.count_nonzero(results['weights'][index])
+        print(f'{date} → {results["dates"][index + 1]}: {picks} picks, return {results["returns"][index] * 100:.2f}%')
+    print(f'Cumulative return: {results["cumulative"] * 100:.2f}%')
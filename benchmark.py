@@ -0,0 +1,274 @@
+# The code in this file benchmarks HedgeHog end to end without touching the real APIs.
+# A local HTTP server stands in for the AlphaVantage 'query' endpoint and serves
+# synthetic (or recorded) INCOME_STATEMENT, BALANCE_SHEET, CASH_FLOW and EARNINGS
+# payloads, with a configurable latency and throttling replies, and a fake Gemeni
+# client answers the qualitative analysis requests. pipeline.run, what main.py runs, is
+# then run cold on universes of increasing size, with its files in a temporary
+# directory, measuring throughput (tickers per second), the latency percentiles of
+# each stage (from the metrics registry) and, in a separate run, the peak memory
+# used. Results can be saved and compared against a previous run to track
+# performance changes.
+#
+# Example: python benchmark.py --sizes 4 500 --output bench.json --baseline old_bench.json
+
+import os
+import json
+import types
+import asyncio
+import random
+import argparse
+import tempfile
+import contextlib
+import threading
+import tracemalloc
+import numpy as np
+from time import perf_counter, sleep
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import quant
+import qualit
+import pipeline
+from cache import StatementCache
+from tickers import gics_sectors
+from metrics import metrics
+
+throttle_note = {'Note': 'Thank you for using Alpha Vantage! Our standard API call frequency is 5 calls per minute and 25 calls per day.'}
+
+def synthetic_payload(function : str, symbol : str, years : int = 15):
+    """Builds a plausible AlphaVantage response for a ticker, the same every time."""
+    rng = random.Random(f'{function}{symbol}')
+    dates = [f'{2024 - year}-12-31' for year in range(years)]
+
+    def value(low, high):
+        return str(rng.randint(low, high)) if rng.random() > 0.03 else 'None'
+
+    if function == 'BALANCE_SHEET':
+        reports = [{'fiscalDateEnding': date, 'totalLiabilities': value(10**9, 5 * 10**9),
+                    'totalShareholderEquity': value(10**9, 5 * 10**9), 'totalAssets': value(5 * 10**9, 10**10),
+                    'cashAndCashEquivalentsAtCarryingValue': value(10**8, 10**9),
+                    'totalCurrentAssets': value(10**9, 2 * 10**9), 'currentNetReceivables': value(10**8, 5 * 10**8),
+                    'totalCurrentLiabilities': value(10**9, 3 * 10**9), 'commonStock': value(10**8, 2 * 10**8)}
+                   for date in dates]
+    elif function == 'INCOME_STATEMENT':
+        reports = [{'fiscalDateEnding': date, 'ebitda': value(10**9, 3 * 10**9),
+                    'operatingExpenses': value(10**9, 3 * 10**9)} for date in dates]
+    elif function == 'CASH_FLOW':
+        reports = [{'fiscalDateEnding': date, 'operatingCashflow': value(10**9, 3 * 10**9)} for date in dates]
+    elif function == 'EARNINGS':
+        return {'symbol': symbol,
+                'annualEarnings': [{'fiscalDateEnding': date, 'reportedEPS': f'{rng.uniform(0, 10):.2f}'} for date in dates],
+                'quarterlyEarnings': [{'fiscalDateEnding': date, 'reportedDate': f'{int(date[:4]) + 1}-01-30'} for date in dates]}
+    else:
+        return {'Error Message': 'Invalid API call. Please retry or visit the documentation for ' + function}
+
+    return {'symbol': symbol, 'annualReports': reports}
+
+class AlphaVantageStandIn:
+    """Local HTTP server answering AlphaVantage 'query' requests. Every reply is delayed
+       by latency seconds and every throttle_every-th request (if set) gets a rate
+       limit reply instead. Responses recorded in a statement cache directory are
+       served as they are, and synthetic ones are made up for everything else."""
+
+    def __init__(self, latency : float = 0.0, throttle_every : int = 0, recorded : str = None):
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.recorded = StatementCache(recorded) if recorded else None
+        self.requests = 0
+        self.lock = threading.Lock()
+
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = parse_qs(urlparse(self.path).query)
+                body = stand_in.reply(query.get('function', [''])[0], query.get('symbol', [''])[0])
+                payload = json.dumps(body).encode()
+
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}/query'
+
+    def reply(self, function : str, symbol : str):
+        """Returns the body of the reply to a request."""
+        with self.lock:
+            self.requests += 1
+            throttled = self.throttle_every and self.requests % self.throttle_every == 0
+
+        sleep(self.latency)
+
+        if throttled:
+            return throttle_note
+
+        if self.recorded is not None:
+            entry = self.recorded.load(symbol, function)
+            if entry is not None:
+                return entry['data']
+
+        return synthetic_payload(function, symbol)
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+class FakeGemeni:
+    """Stands in for the Gemeni model of qualit.py. Answers the structured requests of
+       the qualitative analysis with made-up scores after latency seconds, and the
+       free-text ones with a bare number."""
+
+    def __init__(self, latency : float = 0.0):
+        self.latency = latency
+        self.calls = 0
+        self.rng = random.Random(0)
+
+    def generate_content(self, prompt : str, generation_config : dict = None):
+        self.calls += 1
+        sleep(self.latency)
+        return self.reply(prompt, generation_config)
+
+    async def generate_content_async(self, prompt : str, generation_config : dict = None):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        return self.reply(prompt, generation_config)
+
+    def reply(self, prompt : str, generation_config : dict = None):
+        schema = (generation_config or {}).get('response_schema')
+
+        if schema is None:
+            text = f'{self.rng.random():.2f}'
+        elif schema['type'] == 'object':
+            text = json.dumps({name: round(self.rng.random(), 2) for name in schema['properties']})
+        else:
+            properties = schema['items']['properties']
+            if 'sector' in properties and 'enum' in properties['sector']:
+                entities = prompt.split('tickers are ')[1].rstrip('.').split(', ')
+                text = json.dumps([{'ticker': ticker, 'sector': self.rng.choice(gics_sectors)} for ticker in entities])
+            elif 'sector' in properties:
+                entities = prompt.split('sectors: ')[1].split('. ')[0].split(', ')
+                text = json.dumps([{'sector': sector, 'score': round(self.rng.random(), 2)} for sector in entities])
+            else:
+                entities = prompt.split('tickers are ')[1].split(', give')[0].split(', ')
+                text = json.dumps([{'ticker': ticker, **{name: round(self.rng.random(), 2) for name in properties if name != 'ticker'}}
+                                   for ticker in entities])
+
+        return types.SimpleNamespace(text=text)
+
+def stage_summary(samples : dict):
+    """Returns the count, total and p50/p90/p99 latencies (in ms) of every stage, from
+       the samples (in seconds) of the metrics registry."""
+    return {stage: {'count': len(stage_samples), 'total_s': float(np.sum(stage_samples)),
+                    **{f'p{q}_ms': float(np.percentile(stage_samples, q) * 1000) for q in (50, 90, 99)}}
+            for stage, stage_samples in samples.items()}
+
+def cold_run(universe : list, workers : int, qualit_batch_size : int):
+    """Runs pipeline.run, what main.py runs, on a universe from empty caches, with every
+       file of the run in a temporary directory. Returns the result of the run."""
+    with tempfile.TemporaryDirectory() as run_dir, open(os.devnull, 'w') as devnull:
+        path = lambda name: os.path.join(run_dir, name)
+
+        # Points the caches, circuit breaker and request ledger of quant.py and qualit.py
+        # (shared by every module that imported them) at the temporary directory
+        quant.statement_cache.directory = path('cache')
+        quant.statement_cache.hits = quant.statement_cache.misses = 0
+        qualit.qualit_cache.directory = path('qualitative')
+        qualit.qualit_cache.kinds = {}
+        quant.circuit_breaker.path, quant.circuit_breaker.saved, quant.circuit_breaker.process_only = path('breaker.json'), {}, {}
+        quant.request_ledger.path, quant.request_ledger.days = path('ledger.json'), {}
+        metrics.reset()
+
+        with contextlib.redirect_stdout(devnull):
+            return pipeline.run(1000, universe, portfolio_path=path('portfolio.txt'), av_api_key='benchmark',
+                                av_requests_per_minute=10**9, gemeni_requests_per_minute=10**9, fetch_workers=workers,
+                                qualit_batch_size=qualit_batch_size, gemeni_concurrency=workers,
+                                journal_path=path('journal.jsonl'), score_index_path=path('score_index.json'),
+                                store_path=path('store'), history_path=path('history.sqlite'),
+                                report_path=path('run_report.json'), prometheus_path=path('run_metrics.prom'),
+                                score_params_path=path('score_params.json'))
+
+def benchmark(size : int, latency : float, gemeni_latency : float, throttle_every : int, workers : int,
+              qualit_batch_size : int, recorded : str = None, memory : bool = True):
+    """Benchmarks a cold run of the pipeline on a synthetic universe of size tickers.
+       Returns the measurements as a dictionary. The peak memory is measured by a second
+       cold run, since tracing allocations slows down the one that is timed."""
+    universe = [f'T{index:05d}' for index in range(size)]
+
+    with AlphaVantageStandIn(latency, throttle_every, recorded) as stand_in:
+        quant.alphavantage_url = stand_in.url
+        qualit.gemeni = FakeGemeni(gemeni_latency)
+
+        start = perf_counter()
+        result = cold_run(universe, workers, qualit_batch_size)
+        elapsed = perf_counter() - start
+
+        measurements = {'tickers': size, 'analysed': len(result['scores']), 'seconds': elapsed,
+                        'tickers_per_second': size / elapsed, 'peak_memory_mb': None,
+                        'alphavantage_requests': stand_in.requests, 'gemeni_calls': qualit.gemeni.calls,
+                        'stages': stage_summary(metrics.samples)}
+
+        if memory:
+            tracemalloc.start()
+            cold_run(universe, workers, qualit_batch_size)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            measurements['peak_memory_mb'] = peak / 2**20
+
+        return measurements
+
+def print_results(results : list, baseline : dict = None):
+    """Prints the results of the benchmark, compared to a baseline if one is given."""
+    for result in results:
+        line = (f'{result["tickers"]:>6} tickers: {result["tickers_per_second"]:10.1f} tickers/s, '
+                f'{result["seconds"]:8.2f}s, peak memory ' +
+                ('not measured, ' if result['peak_memory_mb'] is None else f'{result["peak_memory_mb"]:8.1f} MB, ') +
+                f'{result["alphavantage_requests"]} AlphaVantage requests, {result["gemeni_calls"]} Gemeni calls')
+
+        previous = (baseline or {}).get(str(result['tickers']))
+        if previous:
+            change = (result['tickers_per_second'] / previous['tickers_per_second'] - 1) * 100
+            line += f' ({change:+.1f}% throughput vs. baseline)'
+        print(line)
+
+        for stage, stats in result['stages'].items():
+            print(f'        {stage:<32} n={stats["count"]:<7} p50={stats["p50_ms"]:9.3f}ms '
+                  f'p90={stats["p90_ms"]:9.3f}ms p99={stats["p99_ms"]:9.3f}ms total={stats["total_s"]:.2f}s')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks HedgeHog offline, against local stand-ins of AlphaVantage and Gemeni.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 500, 6000], help='universe sizes to benchmark')
+    parser.add_argument('--latency', type=float, default=0.005, help='AlphaVantage stand-in latency, in seconds')
+    parser.add_argument('--gemeni-latency', type=float, default=0.05, help='fake Gemeni latency, in seconds')
+    parser.add_argument('--throttle-every', type=int, default=0, help='reply with a rate limit note every n requests')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent AlphaVantage requests')
+    parser.add_argument('--qualit-batch-size', type=int, default=10, help='companies per Gemeni request')
+    parser.add_argument('--recorded', help='statement cache directory whose responses are served instead of synthetic ones')
+    parser.add_argument('--no-memory', action='store_true', help='skip the second run measuring the peak memory')
+    parser.add_argument('--output', help='JSON file to save the results to')
+    parser.add_argument('--baseline', help='JSON file of previous results to compare against')
+    args = parser.parse_args()
+
+    results = [benchmark(size, args.latency, args.gemeni_latency, args.throttle_every, args.workers,
+                         args.qualit_batch_size, args.recorded, not args.no_memory) for size in args.sizes]
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = {str(result['tickers']): result for result in json.load(baseline_file)}
+
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=4)
@@ -0,0 +1,209 @@
+# The code in this file keeps the AlphaVantage responses on disk, so that statements
+# which have not changed since the last run don't need to be downloaded again. Annual
+# reports only change once a year, so most of the API quota would otherwise be spent
+# on data HedgeHog already has. Each entry is stored in its own JSON file, keyed by
+# ticker and API function, along with the time it was fetched and the latest fiscal
+# period it covers. An entry is considered stale when its time-to-live runs out, or
+# when a newer fiscal year's report should have been published since it was fetched.
+# The Gemeni scores of the qualitative analysis are cached here as well, keyed by
+# question kind, entity (ticker or sector) and date bucket.
+
+import os
+import json
+import tempfile
+import threading
+from time import time
+from datetime import datetime
+
+DAY = 24 * 60 * 60
+
+# How long each kind of response is trusted, in seconds
+default_ttls = {
+    'INCOME_STATEMENT': 90 * DAY,
+    'BALANCE_SHEET': 90 * DAY,
+    'CASH_FLOW': 90 * DAY,
+    'EARNINGS': 7 * DAY,
+}
+
+# Time companies usually take to publish their annual report after the fiscal year ends
+filing_lag = 90 * DAY
+
+def latest_fiscal_date(data : dict):
+    """Returns the most recent fiscalDateEnding of an AlphaVantage response as a
+       string, or None if the response has no annual data."""
+    for reports_key in ('annualReports', 'annualEarnings'):
+        reports = data.get(reports_key)
+        if reports:
+            return reports[0].get('fiscalDateEnding')
+    return None
+
+def next_filing_expected(fiscal_date : str):
+    """Returns the timestamp at which the report following the fiscal year ending on
+       fiscal_date ('YYYY-MM-DD') is expected to be available."""
+    fiscal_end = datetime.strptime(fiscal_date, '%Y-%m-%d').timestamp()
+    return fiscal_end + 365 * DAY + filing_lag
+
+# How long each kind of qualitative score is reused, in seconds. 'sector_of' is the
+# sector a ticker is classified in, which almost never changes.
+default_qualit_ttls = {
+    'company': 7 * DAY,
+    'leadership': 30 * DAY,
+    'sector': 7 * DAY,
+    'esg': 90 * DAY,
+    'sector_of': 180 * DAY,
+}
+
+def atomic_write_json(path : str, data):
+    """Writes data as JSON to a temporary file first and then moves it in place, so
+       the file at path is never left half-written."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(file_descriptor, 'w') as temp_file:
+            json.dump(data, temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def is_cacheable(data : dict):
+    """Checks that an AlphaVantage response holds actual data rather than an error
+       or rate limit message, which must never be cached."""
+    return isinstance(data, dict) and bool(set(data) - {'Information', 'Note', 'Error Message'})
+
+class StatementCache:
+    """On-disk cache of AlphaVantage responses. In offline mode the cache is never
+       bypassed: stale entries are still served and missing ones raise a LookupError."""
+
+    def __init__(self, directory : str = 'cache', ttls : dict = None, offline : bool = False):
+        self.directory = directory
+        self.ttls = dict(default_ttls, **(ttls or {}))
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def path(self, ticker : str, function : str):
+        """Returns the path of the file holding the entry of a ticker and function."""
+        return os.path.join(self.directory, function, f'{ticker}.json')
+
+    def load(self, ticker : str, function : str):
+        """Returns the raw cache entry of a ticker and function, or None if there is
+           none. Entries are dictionaries with 'fetched_at', 'fiscal_period' and 'data'."""
+        try:
+            with open(self.path(ticker, function)) as entry_file:
+                return json.load(entry_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def is_fresh(self, entry : dict, function : str, now : float = None):
+        """Checks whether a cache entry can still be trusted."""
+        now = time() if now is None else now
+
+        if now - entry['fetched_at'] > self.ttls.get(function, 0):
+            return False
+
+        # A newer annual report should be out, and we fetched before it was
+        if entry['fiscal_period'] is not None:
+            expected = next_filing_expected(entry['fiscal_period'])
+            if now >= expected and entry['fetched_at'] < expected:
+                return False
+
+        return True
+
+    def get(self, ticker : str, function : str, stale_ok : bool = False):
+        """Returns the cached response of a ticker and function if it is fresh (or if
+           it is there at all with stale_ok), and None otherwise. Counts the lookup as
+           a hit or a miss."""
+        entry = self.load(ticker, function)
+
+        if entry is not None and (self.offline or stale_ok or self.is_fresh(entry, function)):
+            with self.lock:
+                self.hits += 1
+            return entry['data']
+
+        with self.lock:
+            self.misses += 1
+
+        if self.offline or stale_ok:
+            raise LookupError(f'{function} OF {ticker} IS NOT CACHED')
+
+        return None
+
+    def store(self, ticker : str, function : str, data : dict):
+        """Writes a response to the cache, atomically."""
+        if not is_cacheable(data):
+            return
+
+        entry = {'fetched_at': time(), 'fiscal_period': latest_fiscal_date(data), 'data': data}
+
+        atomic_write_json(self.path(ticker, function), entry)
+
+    def stats(self):
+        """Returns the hit and miss counts of the cache as a dictionary."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+class QualitativeCache:
+    """On-disk cache of qualitative scores, with one JSON file per question kind. The
+       entries are keyed by entity and date bucket: the bucket of a kind changes every
+       time its TTL elapses, after which its scores are asked for again."""
+
+    def __init__(self, directory : str = os.path.join('cache', 'QUALITATIVE'), ttls : dict = None):
+        self.directory = directory
+        self.ttls = dict(default_qualit_ttls, **(ttls or {}))
+        self.kinds = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+        # Serializes the loading and rewriting of the kinds, so that concurrent
+        # store_many calls (e.g. rescores of the daemon) don't lose each other's answers
+        self.kinds_lock = threading.RLock()
+
+    def bucket(self, kind : str, now : float = None):
+        """Returns the current date bucket of a question kind."""
+        now = time() if now is None else now
+        return int(now // self.ttls[kind])
+
+    def entries(self, kind : str):
+        """Returns the entries of a kind, loading them from disk the first time."""
+        with self.kinds_lock:
+            if kind not in self.kinds:
+                try:
+                    with open(os.path.join(self.directory, f'{kind}.json')) as kind_file:
+                        self.kinds[kind] = json.load(kind_file)
+                except (FileNotFoundError, json.JSONDecodeError):
+                    self.kinds[kind] = {}
+            return self.kinds[kind]
+
+    def get(self, kind : str, entity : str):
+        """Returns the cached answer of a kind for an entity in the current bucket, or
+           None if there is none. Counts the lookup as a hit or a miss."""
+        value = self.entries(kind).get(f'{entity}|{self.bucket(kind)}')
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+
+        return value
+
+    def store_many(self, kind : str, answers : dict):
+        """Caches the answers of a kind, given as {entity: answer}, in the current
+           bucket. Entries of older buckets are dropped on the way."""
+        bucket = self.bucket(kind)
+
+        with self.kinds_lock:
+            entries = {key: value for key, value in self.entries(kind).items() if key.endswith(f'|{bucket}')}
+            entries.update({f'{entity}|{bucket}': answer for entity, answer in answers.items()})
+
+            self.kinds[kind] = entries
+            atomic_write_json(os.path.join(self.directory, f'{kind}.json'), entries)
+
+    def stats(self):
+        """Returns the hit and miss counts of the cache as a dictionary."""
+        return {'hits': self.hits, 'misses': self.misses}
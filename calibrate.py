@@ -0,0 +1,236 @@
+# The code in this file fits the distribution parameters scorecalc.py scores ratios on
+# to actual data, instead of hand-picked constants. 'fit' estimates the (std, mean) of
+# every metric from the current ratios of the cached universe (those of the fiscal
+# year the pipeline scores), optionally for each sector separately (with the sectors
+# the qualitative analysis classified the companies in). The estimates are robust ones
+# (median, and the median absolute deviation scaled to a standard deviation), since a
+# few extreme ratios would otherwise skew them. 'sweep' then tries many variations of
+# a parameter table on historical data: each candidate scales the standard deviations
+# and shifts the means of the metrics, and is scored by the cumulative return of the
+# portfolios it would have selected (see backtest.py). The ratios are calculated once
+# and the candidates are evaluated in chunks across a pool of processes, each chunk in
+# one NumPy pass. Since the best of thousands of candidates on a dozen periods is
+# mostly luck, the last rebalance dates are held out: the candidates are ranked on the
+# earlier ones, and the best few are compared on the held-out periods, the current
+# parameters being kept unless one of them beats them there too.
+# 'fit' writes the parameters to score_params.json, which scorecalc.py loads. 'sweep'
+# writes them to swept_params.json, to be reviewed before being copied over it.
+
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from cache import atomic_write_json
+from quant import statement_cache
+from qualit import qualit_cache
+from scorecalc import distribution_params, sector_params, params_table, score_matrix, average_scores, load_score_params
+from statements import UniversePanel
+from store import FundamentalsStore
+from backtest import (default_metrics, load_cached_statements, load_prices, point_in_time_ratios, select_portfolios,
+                      stock_returns, weighted_returns, default_rebalance_dates, scored_year)
+
+# Sectors with fewer companies than this keep the universe-wide parameters
+min_sector_companies = 20
+
+def cached_tickers():
+    """Returns every ticker whose balance sheet is in the statement cache."""
+    try:
+        names = os.listdir(os.path.join(statement_cache.directory, 'BALANCE_SHEET'))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-len('.json')] for name in names if name.endswith('.json'))
+
+def load_panel(store_path : str = None):
+    """Returns the statements of the universe, from a fundamentals store or else from
+       every company of the statement cache."""
+    if store_path is not None:
+        return FundamentalsStore(store_path).panel()
+    return UniversePanel.from_statements(load_cached_statements(cached_tickers()))
+
+def panel_sectors(panel : UniversePanel):
+    """Returns the sector of every company of a panel, None where it is unknown."""
+    return [qualit_cache.get('sector_of', ticker) for ticker in panel.tickers]
+
+def robust_params(values : np.ndarray):
+    """Estimates the (std, mean) of a set of ratios from their median and median
+       absolute deviation. Returns None if there are too few ratios to tell."""
+    values = values[np.isfinite(values)]
+    if len(values) < 2:
+        return None
+
+    median = float(np.median(values))
+    std = 1.4826 * float(np.median(np.abs(values - median)))
+    if std == 0:
+        std = float(np.std(values))
+
+    return (std, median) if std > 0 else None
+
+def calibrate(panel : UniversePanel, metrics : list = default_metrics, sectors : list = None, on_date : str = None):
+    """Estimates the distribution parameters of metrics from the ratios of a panel as
+       of on_date (today by default), and for every sector with enough companies if
+       the sectors of the companies are given. The ratios are those of the fiscal year
+       the pipeline scores. Returns them in the format of the parameter file:
+       {'distribution_params': {...}, 'sector_params': {...}}."""
+    on_date = np.datetime64('today') if on_date is None else np.datetime64(on_date)
+    ratios = point_in_time_ratios(panel, metrics, np.array([on_date], dtype='datetime64[D]'), scored_year)[0]
+
+    params = {'distribution_params': {}, 'sector_params': {}}
+
+    for column, metric in enumerate(metrics):
+        estimate = robust_params(ratios[:, column])
+        params['distribution_params'][metric] = list(estimate or distribution_params[metric])
+
+    for sector in sorted(set(sectors or []) - {None}):
+        rows = [row for row, company_sector in enumerate(sectors) if company_sector == sector]
+        if len(rows) < min_sector_companies:
+            continue
+
+        estimates = {metric: robust_params(ratios[rows, column]) for column, metric in enumerate(metrics)}
+        params['sector_params'][sector] = {metric: list(estimate) for metric, estimate in estimates.items() if estimate}
+
+    return params
+
+def save_params(params : dict, path : str = 'score_params.json'):
+    """Writes a parameter table where scorecalc.py loads it from."""
+    atomic_write_json(path, params)
+
+# Data the sweep's worker processes evaluate candidates on, set once per process by init_sweep
+sweep_data = {}
+
+def init_sweep(ratios : np.ndarray, stds : np.ndarray, means : np.ndarray, returns : np.ndarray):
+    sweep_data.update(ratios=ratios, stds=stds, means=means, returns=returns)
+
+def evaluate(candidates : np.ndarray):
+    """Returns the (candidates x periods) backtest returns of a chunk of candidates, a
+       (candidates x metrics x 2) array of (std scale, mean shift in stds) pairs."""
+    ratios = sweep_data['ratios']
+    stds = sweep_data['stds'] * candidates[:, None, None, :, 0]
+    means = sweep_data['means'] + candidates[:, None, None, :, 1] * sweep_data['stds']
+
+    averages = average_scores(score_matrix(ratios, stds, means))
+    return weighted_returns(select_portfolios(averages), sweep_data['returns'])
+
+def cumulative(returns : np.ndarray):
+    """Returns the cumulative return of every row of period returns."""
+    return np.prod(1 + returns, axis=-1) - 1
+
+def make_candidates(count : int, metrics : list, mode : str = 'random', spread : float = 2.0, shift : float = 1.0,
+                    seed : int = 0):
+    """Generates candidates as a (count x metrics x 2) array of (std scale, mean shift)
+       pairs, the first one leaving the parameters as they are. 'random' draws every
+       metric's pair independently (scales log-uniform between 1/spread and spread,
+       shifts uniform between -shift and shift stds); 'grid' applies the same pair to
+       every metric, on a square grid of about count points."""
+    if mode == 'grid':
+        side = max(int(np.sqrt(count)), 2)
+        scales, shifts = np.meshgrid(np.geomspace(1 / spread, spread, side), np.linspace(-shift, shift, side))
+        pairs = np.stack([scales.ravel(), shifts.ravel()], axis=-1)
+        candidates = np.repeat(pairs[:, None, :], len(metrics), axis=1)
+    else:
+        rng = np.random.default_rng(seed)
+        candidates = np.stack([np.exp(rng.uniform(-np.log(spread), np.log(spread), (count, len(metrics)))),
+                               rng.uniform(-shift, shift, (count, len(metrics)))], axis=-1)
+
+    identity = np.stack([np.ones(len(metrics)), np.zeros(len(metrics))], axis=-1)[None]
+    return np.concatenate([identity, candidates])
+
+def choose_candidate(returns : np.ndarray, holdout : int = 3, finalists : int = 5):
+    """Chooses a candidate from their (candidates x periods) returns: the finalists
+       best on the periods before the last holdout ones, then the finalist best on the
+       held-out periods if it beats the current parameters (candidate 0) there too.
+       Returns the index of the chosen candidate, its cumulative returns on the earlier
+       and held-out periods, and the finalists' indices."""
+    if not 0 < holdout < returns.shape[1]:
+        raise ValueError(f'CANNOT HOLD OUT {holdout} OF {returns.shape[1]} PERIODS')
+
+    training, held_out = cumulative(returns[:, :-holdout]), cumulative(returns[:, -holdout:])
+    best = [int(index) for index in np.argsort(training)[::-1][:finalists]]
+
+    chosen = max(best, key=lambda index: held_out[index])
+    if held_out[chosen] <= held_out[0]:
+        chosen = 0
+
+    return chosen, training, held_out, best
+
+def scaled_params(candidate : np.ndarray, metrics : list):
+    """Applies a candidate to the current parameters, in the format of the parameter file."""
+    def scale(std, mean, column):
+        return [std * candidate[column, 0], mean + candidate[column, 1] * std]
+
+    return {'distribution_params': {metric: scale(*distribution_params[metric], column) for column, metric in enumerate(metrics)},
+            'sector_params': {sector: {metric: scale(*params[metric], metrics.index(metric)) if metric in metrics else list(params[metric])
+                                       for metric in params}
+                              for sector, params in sector_params.items()}}
+
+def sweep(panel : UniversePanel, price_path : str, candidates : np.ndarray, metrics : list = default_metrics,
+          rebalance_dates : list = None, workers : int = None):
+    """Evaluates candidates (see make_candidates) on the current parameters with a
+       backtest over the companies of a panel, across a pool of workers processes.
+       Returns the (candidates x periods) returns of every holding period."""
+    price_dates, price_tickers, prices = load_prices(price_path)
+    dates = default_rebalance_dates(price_dates) if rebalance_dates is None else np.array(rebalance_dates, dtype='datetime64[D]')
+
+    ratios = point_in_time_ratios(panel, metrics, dates, scored_year)
+    returns = stock_returns(dates, panel.tickers, price_dates, price_tickers, prices)
+    stds, means = params_table(metrics, panel_sectors(panel) if sector_params else None)
+
+    # Chunks are sized so that each stays around a few tens of MB of scores
+    chunk_size = max(1, int(2 * 10**6 // max(ratios.size, 1)))
+    chunks = [candidates[start:start + chunk_size] for start in range(0, len(candidates), chunk_size)]
+
+    with ProcessPoolExecutor(workers, initializer=init_sweep, initargs=(ratios, stds, means, returns)) as pool:
+        return np.concatenate(list(pool.map(evaluate, chunks)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Calibrates the distribution parameters of scorecalc.py.')
+    parser.add_argument('--store', help='read the statements from this fundamentals store rather than the statement cache')
+    parser.add_argument('--params', default='score_params.json', help='parameter file holding the current parameters, if it exists')
+    parser.add_argument('--output', help="parameter file to write (score_params.json for 'fit', swept_params.json for 'sweep')")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    fit_parser = commands.add_parser('fit', help='estimate the parameters from the current ratios of the universe')
+    fit_parser.add_argument('--per-sector', action='store_true', help='also estimate parameters for every sector')
+
+    sweep_parser = commands.add_parser('sweep', help='backtest variations of the current parameters and keep the best')
+    sweep_parser.add_argument('prices', help='price history CSV file (see backtest.py)')
+    sweep_parser.add_argument('--mode', choices=('random', 'grid'), default='random')
+    sweep_parser.add_argument('--candidates', type=int, default=2000, help='number of parameter sets to try')
+    sweep_parser.add_argument('--spread', type=float, default=2.0, help='largest factor standard deviations are scaled by')
+    sweep_parser.add_argument('--shift', type=float, default=1.0, help='largest mean shift, in standard deviations')
+    sweep_parser.add_argument('--workers', type=int, help='worker processes (one per core by default)')
+    sweep_parser.add_argument('--seed', type=int, default=0)
+    sweep_parser.add_argument('--dates', nargs='+', help='rebalance dates as YYYY-MM-DD (every April 1st by default)')
+    sweep_parser.add_argument('--holdout', type=int, default=3, help='last holding periods held out to validate the best candidates')
+    sweep_parser.add_argument('--finalists', type=int, default=5, help='best candidates on the earlier periods compared on the held-out ones')
+    args = parser.parse_args()
+
+    load_score_params(args.params)
+    panel = load_panel(args.store)
+
+    if args.command == 'fit':
+        output = args.output or 'score_params.json'
+        params = calibrate(panel, sectors=panel_sectors(panel) if args.per_sector else None)
+        print(f'Calibrated on {len(panel.tickers)} companies, {len(params["sector_params"])} sectors')
+        for metric, (std, mean) in params['distribution_params'].items():
+            print(f'{metric}: std {std:.4g}, mean {mean:.4g}')
+    else:
+        output = args.output or 'swept_params.json'
+        candidates = make_candidates(args.candidates, default_metrics, args.mode, args.spread, args.shift, args.seed)
+        returns = sweep(panel, args.prices, candidates, rebalance_dates=args.dates, workers=args.workers)
+        chosen, training, held_out, finalists = choose_candidate(returns, args.holdout, args.finalists)
+
+        print(f'Evaluated {len(candidates)} parameter sets on {len(panel.tickers)} companies, '
+              f'{returns.shape[1] - args.holdout} periods, {args.holdout} more held out')
+        print(f'Current parameters: cumulative return {training[0] * 100:.2f}%, held out {held_out[0] * 100:.2f}%')
+        for rank, index in enumerate(finalists):
+            print(f'#{rank + 1}: set {index}, cumulative return {training[index] * 100:.2f}%, held out {held_out[index] * 100:.2f}%')
+
+        if chosen == 0:
+            print('No parameter set beats the current parameters on the held-out periods; keeping them')
+        else:
+            print(f'Chose set {chosen}')
+
+        params = scaled_params(candidates[chosen], default_metrics)
+
+    save_params(params, output)
+    print(f'Parameters written to "{output}"')
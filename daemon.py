@@ -0,0 +1,301 @@
+# The code in this file keeps the portfolio up to date continuously, rather than
+# rescanning the whole universe in one-shot runs. It is a long-running asyncio loop
+# which, on a schedule, looks for new annual reports and only refetches and rescores
+# the companies that published one. A company is only checked once the annual report
+# following the one in the statement cache is due (see planner.expected_filing), and
+# then with a single EARNINGS request, the cheapest signal of a new report: its latest
+# fiscalDateEnding tells whether the new fiscal year is out. The companies with new
+# data are queued, refetched and rescored by the same functions as pipeline.run, and
+# every portfolio change is written and reported as soon as it happens. Once the
+# universe has been fetched once, the API is used in proportion to the number of new
+# filings rather than to the size of the universe. Earnings that come out before the
+# statements only trigger one rescore; the statements are then refetched on a backoff
+# until they catch up. Rescores that fail (API outage, unparsable reply...) are tried
+# again on later polls, on a backoff too, from the statements already fetched. So are
+# the companies of the universe with cached statements but no score when it starts.
+
+import asyncio
+import threading
+import numpy as np
+from time import time
+from datetime import datetime
+from cache import DAY, latest_fiscal_date
+from quant import statement_cache, request_ledger, alphavantage_api_request
+from statements import FinancialStatements
+from scorecalc import ratio_matrix, score_universe, load_score_params
+from qualit import qualitative_scores, qualit_cache
+from fetch import TokenBucket
+from planner import company_filing_lag, expected_filing, statement_functions
+from ranking import ScoreIndex, read_portfolio, write_portfolio, portfolio_diff, describe_diff
+from store import FundamentalsStore
+from pipeline import quant_metrics, qualit_metrics
+from metrics import metrics, instrumented
+
+# How long before its expected date a new annual report starts being looked for
+check_margin = 14 * DAY
+
+# Companies whose report is this late (delisted, changing their fiscal year...) are
+# only checked every overdue_recheck seconds instead of on every poll
+overdue_after = 90 * DAY
+overdue_recheck = 7 * DAY
+
+# AlphaVantage often publishes the earnings of a fiscal year before its statements.
+# Companies rescored for new earnings whose statements had not caught up yet are
+# refetched after statements_retry seconds, then twice as long every time, up to
+# statements_retry_cap, instead of on every poll
+statements_retry = 1 * DAY
+statements_retry_cap = 7 * DAY
+
+# Failed rescores are retried after rescore_retry seconds, then twice as long every
+# time, up to rescore_retry_cap
+rescore_retry = 1 * 60 * 60
+rescore_retry_cap = 1 * DAY
+
+def backoff_due(retries : dict, ticker : str, now : float, delay : float, cap : float):
+    """Checks whether a company's next attempt is due, retries holding when and how
+       many times it was last attempted as {ticker: (time, attempts)}, the attempts
+       being delay seconds apart, then twice as long every time, up to cap. If it is
+       due, counts the attempt."""
+    last_time, attempts = retries.get(ticker, (0.0, 0))
+    if now < last_time + min(delay * 2**attempts, cap):
+        return False
+
+    retries[ticker] = (now, attempts + 1)
+    return True
+
+def due_for_check(ticker : str, now : float = None, last_checked : float = None):
+    """Checks whether a new annual report of a company may be out. Companies never
+       fetched are always due. last_checked is when the company was last checked for
+       a new report, if it was."""
+    now = time() if now is None else now
+
+    entry = statement_cache.load(ticker, 'BALANCE_SHEET')
+    if entry is None or entry['fiscal_period'] is None:
+        return True
+
+    earnings_entry = statement_cache.load(ticker, 'EARNINGS')
+    lag = None if earnings_entry is None else company_filing_lag(earnings_entry['data'])
+
+    expected = expected_filing(entry['fiscal_period'], lag)
+
+    if now >= expected + overdue_after and last_checked is not None:
+        return now >= last_checked + overdue_recheck
+
+    return now >= expected - check_margin
+
+class PortfolioMonitor:
+    """Rescores companies one at a time and keeps the portfolio file up to date."""
+
+    def __init__(self, total_budget : float, universe : list, av_api_key : str, limiter : TokenBucket,
+                 gemeni_limiter : TokenBucket, portfolio_path : str = 'portfolio.txt',
+                 score_index_path : str = 'score_index.json', store_path : str = 'store', on_update = None,
+                 gemeni_concurrency : int = 8, gemeni_timeout : float = 60):
+        self.total_budget = total_budget
+        self.universe = universe
+        self.av_api_key = av_api_key
+        self.limiter = limiter
+        self.gemeni_limiter = gemeni_limiter
+        self.portfolio_path = portfolio_path
+        self.score_index = ScoreIndex(score_index_path)
+        self.store = FundamentalsStore(store_path)
+        self.on_update = on_update
+        self.gemeni_concurrency = gemeni_concurrency
+        self.gemeni_timeout = gemeni_timeout
+        self.lock = threading.Lock()
+
+        # Companies queued for a rescore, which are not checked again until it is done,
+        # and when each company was last checked for a new report
+        self.pending = set()
+        self.last_checked = {}
+
+        # Companies rescored for new earnings, as {ticker: earnings fiscal date}, until
+        # their statements cover that fiscal date, and when and how many times their
+        # statements were last refetched, as {ticker: (time, attempts)}
+        self.acted_on = {}
+        self.statement_retries = {}
+
+        # Companies whose rescore failed, as {ticker: (time, attempts)}, until one succeeds.
+        # Companies with cached statements that aren't in the index failed before a restart
+        self.failed_rescores = {ticker: (0.0, 0) for ticker in universe if ticker not in self.score_index
+                                and statement_cache.load(ticker, 'BALANCE_SHEET') is not None}
+
+    def has_new_report(self, ticker : str):
+        """Asks for the EARNINGS of a company and checks whether they cover a fiscal
+           year more recent than its cached statements. Companies never fetched have
+           nothing to compare with and are rescored right away. Earnings already acted
+           on don't requeue the company: its statements are refetched on a backoff
+           until they catch up, without asking for the EARNINGS again."""
+        entry = statement_cache.load(ticker, 'BALANCE_SHEET')
+        if entry is None:
+            return True
+
+        cached_period = entry['fiscal_period'] or ''
+        now = time()
+
+        if ticker in self.acted_on:
+            if cached_period >= self.acted_on[ticker]:
+                del self.acted_on[ticker]
+                self.statement_retries.pop(ticker, None)
+            else:
+                return self.statements_due(ticker, now)
+
+        earnings = alphavantage_api_request(ticker, 'EARNINGS', self.av_api_key, self.limiter, refresh=True)
+        self.last_checked[ticker] = now
+        latest = latest_fiscal_date(earnings)
+
+        metrics.count('monitor_checks', ticker)
+        if latest is None or latest <= cached_period:
+            return False
+
+        self.acted_on[ticker] = latest
+        self.statement_retries[ticker] = (now, 0)
+        return True
+
+    def statements_due(self, ticker : str, now : float):
+        """Checks whether the statements of a company rescored for new earnings are due
+           to be refetched, and if so counts the attempt."""
+        if not backoff_due(self.statement_retries, ticker, now, statements_retry, statements_retry_cap):
+            return False
+
+        metrics.count('monitor_statement_retries', ticker)
+        return True
+
+    def rescore_due(self, ticker : str, now : float):
+        """Checks whether the failed rescore of a company is due to be tried again, and
+           if so counts the attempt."""
+        if ticker not in self.failed_rescores or not backoff_due(self.failed_rescores, ticker, now, rescore_retry, rescore_retry_cap):
+            return False
+
+        metrics.count('monitor_rescore_retries', ticker)
+        return True
+
+    @instrumented('monitor_rescore', ticker_arg=1)
+    def rescore(self, ticker : str):
+        """Refetches the statements of a company, rescores it and reselects the
+           portfolio. Returns the changes of the portfolio (see ranking.portfolio_diff).
+           Retries of failed rescores only fetch the statements that aren't fresh in the
+           cache, since the failed attempt already refetched them."""
+        refresh = None if ticker in self.failed_rescores else True
+        responses = {function: alphavantage_api_request(ticker, function, self.av_api_key, self.limiter, refresh=refresh)
+                     for function in statement_functions}
+
+        statements = FinancialStatements.from_reports(responses['BALANCE_SHEET'], responses['INCOME_STATEMENT'])
+        statements.ticker = ticker
+        ratios = [ratio_function(statements) for _, ratio_function, _ in quant_metrics]
+
+        qualit_scores, qualit_errors = qualitative_scores([ticker], limiter=self.gemeni_limiter,
+                                                         concurrency=self.gemeni_concurrency, timeout=self.gemeni_timeout)
+        if ticker in qualit_errors:
+            raise qualit_errors[ticker]
+
+        qualit_scores = qualit_scores[ticker]
+        qualit = np.array([[qualit_scores[kind] for _, kind in qualit_metrics]], dtype=float)
+
+        _, averages = score_universe(ratio_matrix([ratios]), [metric for _, _, metric in quant_metrics], qualit,
+                                     [qualit_cache.get('sector_of', ticker)])
+        average = None if np.isnan(averages[0]) else float(averages[0])
+
+        # Only one company's update of the shared index and portfolio at a time
+        with self.lock:
+            self.store.append([statements])
+            self.score_index.update({ticker: average})
+            self.score_index.save()
+
+            previous_portfolio = read_portfolio(self.portfolio_path)
+            portfolio = {pick: round(weight * self.total_budget, 2) for pick, weight in self.score_index.select()}
+            write_portfolio(self.portfolio_path, portfolio)
+
+        return portfolio_diff(previous_portfolio, portfolio)
+
+    def report(self, ticker : str, diff : dict):
+        """Reports the portfolio changes a rescore brought."""
+        stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        lines = describe_diff(diff)
+
+        print(f'[{stamp}] {ticker} rescored: ' + ('; '.join(lines) if lines else 'no portfolio change'))
+
+        if self.on_update is not None:
+            self.on_update(ticker, diff)
+
+async def poll(monitor : PortfolioMonitor, queue : asyncio.Queue, interval : float, cycles : int = None):
+    """Every interval seconds, checks the companies whose new annual report is due and
+       queues the ones that have one. Stops after cycles checks if it is given."""
+    cycle = 0
+
+    while cycles is None or cycle < cycles:
+        now = time()
+
+        # Failed rescores due to be tried again are queued without checking for a report
+        for ticker in list(monitor.failed_rescores):
+            if ticker not in monitor.pending and monitor.rescore_due(ticker, now):
+                monitor.pending.add(ticker)
+                await queue.put(ticker)
+
+        due = [ticker for ticker in monitor.universe if ticker not in monitor.pending
+               and due_for_check(ticker, now, monitor.last_checked.get(ticker))]
+
+        for ticker in due:
+            try:
+                new_report = await asyncio.to_thread(monitor.has_new_report, ticker)
+            except Exception as error:
+                print(f'Could not check {ticker} for a new report: {error}')
+                continue
+
+            if new_report:
+                # A new report calls for a full refetch, even if a rescore had failed
+                monitor.failed_rescores.pop(ticker, None)
+                monitor.pending.add(ticker)
+                await queue.put(ticker)
+
+        cycle += 1
+        if cycles is None or cycle < cycles:
+            await asyncio.sleep(interval)
+
+async def rescore_worker(monitor : PortfolioMonitor, queue : asyncio.Queue):
+    """Rescores the queued companies as they come."""
+    while True:
+        ticker = await queue.get()
+        try:
+            diff = await asyncio.to_thread(monitor.rescore, ticker)
+            monitor.failed_rescores.pop(ticker, None)
+            monitor.report(ticker, diff)
+        except Exception as error:
+            # Tried again on a later poll (see PortfolioMonitor.rescore_due)
+            print(f'Could not rescore {ticker}: {error!r}')
+            monitor.failed_rescores.setdefault(ticker, (time(), 0))
+        finally:
+            monitor.pending.discard(ticker)
+            queue.task_done()
+
+async def watch(total_budget : float, universe : list, av_api_key : str = None, interval : float = 6 * 60 * 60,
+                av_requests_per_minute : float = 5, gemeni_requests_per_minute : float = 15, workers : int = 2,
+                portfolio_path : str = 'portfolio.txt', score_index_path : str = 'score_index.json',
+                store_path : str = 'store', cycles : int = None, on_update = None, av_daily_budget : int = None,
+                gemeni_concurrency : int = 8, gemeni_timeout : float = 60, score_params_path : str = 'score_params.json'):
+    """Monitors a universe and keeps the portfolio bought with total_budget up to date,
+       checking for new reports every interval seconds, with workers rescores at once.
+       on_update, if given, is called with the ticker and the portfolio changes after
+       every rescore. See pipeline.run for the other parameters. Runs forever,
+       unless cycles is given, in which case it returns once that many checks are done
+       and every company they queued is rescored."""
+    if av_api_key is None:
+        from apikeys import alphavantage_api_key as av_api_key
+
+    # Report checks and rescores draw from the same daily budget as the runs
+    request_ledger.limit = av_daily_budget
+    load_score_params(score_params_path)
+
+    monitor = PortfolioMonitor(total_budget, universe, av_api_key, TokenBucket(av_requests_per_minute),
+                               TokenBucket(gemeni_requests_per_minute), portfolio_path, score_index_path,
+                               store_path, on_update, gemeni_concurrency, gemeni_timeout)
+    queue = asyncio.Queue()
+    worker_tasks = [asyncio.create_task(rescore_worker(monitor, queue)) for _ in range(workers)]
+
+    print(f'Monitoring {len(universe)} companies, checking for new reports every {interval / 60:.0f} minutes')
+
+    try:
+        await poll(monitor, queue, interval, cycles)
+        await queue.join()
+    finally:
+        for task in worker_tasks:
+            task.cancel()
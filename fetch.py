@@ -0,0 +1,97 @@
+# The code in this file fetches the AlphaVantage statements of a whole universe of
+# tickers at once. Instead of requesting one statement at a time and sleeping between
+# calls, every request is queued on a thread pool sharing the pooled session from
+# quant.py, and a token bucket makes sure the API key's requests-per-minute budget is
+# never exceeded. The total run time then only depends on that budget. Statements
+# found in the cache (see cache.py) are served without using up any of it. Once the
+# API refuses requests (daily limit or budget reached), no more are sent and the
+# statements left are served from the cache, however old, where there is a copy.
+
+import threading
+from time import monotonic, sleep
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from quant import alphavantage_api_request
+from metrics import metrics, instrumented
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter. Allows at most requests_per_minute
+       calls per minute on average, with bursts of up to burst calls."""
+
+    def __init__(self, requests_per_minute : float, burst : int = 1):
+        self.rate = requests_per_minute / 60
+        self.capacity = max(1, burst)
+        self.tokens = float(self.capacity)
+        self.last_refill = monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a token is available, then consumes it. The time spent waiting
+           is recorded as the 'rate_limit_wait' stage."""
+        with metrics.timed('rate_limit_wait'):
+            self.wait_for_token()
+
+    def wait_for_token(self):
+        """Blocks until a token is available, then consumes it."""
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                wait = (1 - self.tokens) / self.rate
+
+            sleep(wait)
+
+def fetch_statement(ticker : str, function : str, av_api_key : str, limiter : TokenBucket, refresh : bool, refusals : list):
+    """Fetches one statement for fetch_universe. Once the API refused a request (the
+       refusals so far are in refusals), the statement is only looked up in the cache,
+       however old the cached copy is; if there is none, the first refusal is raised."""
+    if not refusals:
+        try:
+            return alphavantage_api_request(ticker, function, av_api_key, limiter, refresh)
+        except ConnectionRefusedError as error:
+            refusals.append(error)
+
+    try:
+        return alphavantage_api_request(ticker, function, av_api_key, limiter, refresh=False)
+    except LookupError:
+        raise refusals[0] from None
+
+@instrumented()
+def fetch_universe(tickers : list, av_api_key : str, functions : tuple = ('INCOME_STATEMENT', 'BALANCE_SHEET'),
+                   requests_per_minute : float = 5, max_workers : int = 8, burst : int = 1, refresh : set = None):
+    """Fetches every statement in functions for every ticker in tickers concurrently.
+       Returns a dictionary of the form {ticker: {function: parsed_json}} along with
+       a dictionary of the form {ticker: exception} for the tickers that failed. If
+       the API limit is reached, no more requests are sent: the remaining statements
+       are served from the cache however old they are, and only the tickers with a
+       statement that isn't cached fail with the ConnectionRefusedError.
+       If refresh is given (a set of (ticker, function) pairs, see planner.py), only
+       those statements are requested from the API and all others are served from the
+       cache, however old they are."""
+
+    limiter = TokenBucket(requests_per_minute, burst)
+    statements = {ticker: {} for ticker in tickers}
+    errors = {}
+    refusals = []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        jobs = {pool.submit(fetch_statement, ticker, function, av_api_key, limiter,
+                            None if refresh is None else (ticker, function) in refresh, refusals): (ticker, function)
+                for ticker in tickers for function in functions}
+
+        for job in as_completed(jobs):
+            ticker, function = jobs[job]
+            try:
+                statements[ticker][function] = job.result()
+            except Exception as error:
+                errors.setdefault(ticker, error)
+
+    for ticker in errors:
+        del statements[ticker]
+
+    return statements, errors
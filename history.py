@@ -0,0 +1,191 @@
+# The code in this file keeps the history of every analysis run in a SQLite database,
+# so that how the ratios and scores of a company evolved, or what changed between two
+# portfolios, can be looked up without rerunning anything. Every run records the raw
+# value (ratio, or qualitative answer) and the score of every metric of every company,
+# along with the company's average score and the amount allocated to it. A run's rows
+# are inserted in a single transaction. The tables are indexed by (run, ticker, metric)
+# for the per-run lookups and by (ticker, metric, run) for the trends, so queries
+# only read the rows they return, however many runs are stored.
+# Run 'python history.py --help' for the command line interface.
+
+import sqlite3
+import argparse
+import numpy as np
+from time import time
+from datetime import datetime
+from ranking import portfolio_diff, describe_diff
+
+schema = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    budget REAL,
+    companies INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metric_values (
+    run INTEGER NOT NULL REFERENCES runs(run),
+    ticker TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    score REAL,
+    PRIMARY KEY (run, ticker, metric)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metric_values_by_ticker ON metric_values (ticker, metric, run);
+CREATE TABLE IF NOT EXISTS allocations (
+    run INTEGER NOT NULL REFERENCES runs(run),
+    ticker TEXT NOT NULL,
+    average REAL,
+    amount REAL,
+    PRIMARY KEY (run, ticker)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS allocations_by_ticker ON allocations (ticker, run);
+'''
+
+def nullable(value):
+    """Converts a value to a float for the database, NaN and None becoming NULL."""
+    return None if value is None or value != value else float(value)
+
+class RunHistory:
+    """SQLite database of the ratios, scores and allocations of every analysis run."""
+
+    def __init__(self, path : str = 'history.sqlite'):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def record_run(self, tickers : list, metrics : list, values : np.ndarray, scores : np.ndarray, averages : np.ndarray,
+                   portfolio : dict, budget : float = None, started_at : float = None):
+        """Records a run: the (companies x metrics) arrays of values and scores of the
+           tickers, their average scores and the portfolio ({ticker: amount}) selected.
+           Returns the number of the run."""
+        # Plain lists are much faster to read element by element than NumPy arrays
+        values, scores, averages = (np.asarray(array, dtype=float).tolist() for array in (values, scores, averages))
+
+        with self.connection:
+            run = self.connection.execute('INSERT INTO runs (started_at, budget, companies) VALUES (?, ?, ?)',
+                                          (time() if started_at is None else started_at, budget, len(tickers))).lastrowid
+
+            self.connection.executemany('INSERT INTO metric_values VALUES (?, ?, ?, ?, ?)',
+                                        ((run, ticker, metric, nullable(values[row][column]), nullable(scores[row][column]))
+                                         for row, ticker in enumerate(tickers) for column, metric in enumerate(metrics)))
+
+            self.connection.executemany('INSERT INTO allocations VALUES (?, ?, ?, ?)',
+                                        ((run, ticker, nullable(averages[row]), portfolio.get(ticker))
+                                         for row, ticker in enumerate(tickers)))
+
+        return run
+
+    def runs(self, last : int = None):
+        """Returns the last runs (all of them by default) as (run, started_at, budget,
+           companies) tuples, oldest first."""
+        rows = self.connection.execute('SELECT run, started_at, budget, companies FROM runs ORDER BY run DESC LIMIT ?',
+                                       (-1 if last is None else last,)).fetchall()
+        return rows[::-1]
+
+    def latest_runs(self, count : int = 2):
+        """Returns the numbers of the last count runs, oldest first."""
+        return [run for run, *_ in self.runs(count)]
+
+    def trend(self, ticker : str, metric : str = None, last : int = None):
+        """Returns how a company's metric (its average score and allocation if metric is
+           None) evolved over its last runs, as (run, started_at, value, score) tuples,
+           oldest first. For the average score, value is the amount allocated."""
+        if metric is None:
+            query = ('SELECT a.run, r.started_at, a.amount, a.average FROM allocations a JOIN runs r ON r.run = a.run '
+                     'WHERE a.ticker = ? ORDER BY a.run DESC LIMIT ?')
+            parameters = (ticker, -1 if last is None else last)
+        else:
+            query = ('SELECT m.run, r.started_at, m.value, m.score FROM metric_values m JOIN runs r ON r.run = m.run '
+                     'WHERE m.ticker = ? AND m.metric = ? ORDER BY m.run DESC LIMIT ?')
+            parameters = (ticker, metric, -1 if last is None else last)
+
+        return self.connection.execute(query, parameters).fetchall()[::-1]
+
+    def metrics_of(self, run : int, ticker : str):
+        """Returns the metrics of a company in a run as {metric: (value, score)}."""
+        rows = self.connection.execute('SELECT metric, value, score FROM metric_values WHERE run = ? AND ticker = ?',
+                                       (run, ticker))
+        return {metric: (value, score) for metric, value, score in rows}
+
+    def portfolio(self, run : int):
+        """Returns the portfolio selected by a run, as {ticker: amount}."""
+        rows = self.connection.execute('SELECT ticker, amount FROM allocations WHERE run = ? AND amount IS NOT NULL', (run,))
+        return dict(rows)
+
+    def averages(self, run : int):
+        """Returns the average score of every company scored by a run, as {ticker: average}."""
+        return dict(self.connection.execute('SELECT ticker, average FROM allocations WHERE run = ?', (run,)))
+
+    def diff(self, old_run : int, new_run : int, metric : str = None):
+        """Compares two runs. Returns their portfolio changes (see ranking.portfolio_diff)
+           and the companies whose score changed as {ticker: (old score, new score)}: the
+           score of metric if it is given, the average score otherwise. Companies only
+           scored by one of the runs have None as their other score."""
+        if metric is None:
+            old_scores, new_scores = self.averages(old_run), self.averages(new_run)
+        else:
+            query = 'SELECT ticker, score FROM metric_values WHERE run = ? AND metric = ?'
+            old_scores = dict(self.connection.execute(query, (old_run, metric)))
+            new_scores = dict(self.connection.execute(query, (new_run, metric)))
+
+        changes = {ticker: (old_scores.get(ticker), new_scores.get(ticker)) for ticker in sorted(old_scores.keys() | new_scores.keys())
+                   if old_scores.get(ticker) != new_scores.get(ticker)}
+
+        return {'portfolio': portfolio_diff(self.portfolio(old_run), self.portfolio(new_run)), 'scores': changes}
+
+def run_time(started_at : float):
+    return datetime.fromtimestamp(started_at).strftime('%Y-%m-%d %H:%M')
+
+def number(value, digits : int = 4):
+    return '-' if value is None else f'{value:.{digits}g}'
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Queries the history of the analysis runs.')
+    parser.add_argument('--database', default='history.sqlite', help='run history database')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    runs_parser = commands.add_parser('runs', help='list the runs')
+    runs_parser.add_argument('--last', type=int, help='only the last LAST runs')
+
+    trend_parser = commands.add_parser('trend', help="show how a company's scores evolved")
+    trend_parser.add_argument('ticker')
+    trend_parser.add_argument('metric', nargs='?', help='metric (e.g. debt_to_ebitda, esg); the average score by default')
+    trend_parser.add_argument('--last', type=int, help='only the last LAST runs')
+
+    diff_parser = commands.add_parser('diff', help='compare two runs (the last two by default)')
+    diff_parser.add_argument('runs', nargs='*', type=int, help='the old and new run numbers')
+    diff_parser.add_argument('--metric', help='compare the scores of this metric rather than the average scores')
+    args = parser.parse_args()
+
+    history = RunHistory(args.database)
+
+    if args.command == 'runs':
+        for run, started_at, budget, companies in history.runs(args.last):
+            print(f'#{run}  {run_time(started_at)}  budget {number(budget, 10)}$  {companies} companies')
+
+    elif args.command == 'trend':
+        label = args.metric or 'average score'
+        for run, started_at, value, score in history.trend(args.ticker, args.metric, args.last):
+            detail = f'allocated {number(value, 10)}$' if args.metric is None else f'value {number(value)}'
+            print(f'#{run}  {run_time(started_at)}  {label} {number(score)}  {detail}')
+
+    else:
+        if args.runs and len(args.runs) != 2:
+            parser.error('diff takes two run numbers, or none for the last two runs')
+
+        if not args.runs and len(history.runs(2)) < 2:
+            parser.error('there are fewer than two runs to compare')
+
+        old_run, new_run = args.runs or history.latest_runs(2)
+        diff = history.diff(old_run, new_run, args.metric)
+
+        print(f'Run #{old_run} -> run #{new_run}')
+        for line in describe_diff(diff['portfolio']):
+            print(line)
+        for ticker, (old, new) in diff['scores'].items():
+            print(f'{ticker}: {args.metric or "average score"} {number(old)} -> {number(new)}')
+
+    history.close()
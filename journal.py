@@ -0,0 +1,71 @@
+# The code in this file keeps an append-only journal of an analysis run, so that a run
+# which fails partway through (API limit reached, Gemeni error, malformed statement...)
+# can be resumed instead of started over. Every line of the journal is a JSON record
+# about one ticker: 'fetched' once its statements are downloaded (the statements
+# themselves are kept by the statement cache, see cache.py), 'analysed' with its ratios
+# and qualitative scores, 'scored' with its scores and 'failed' with the error that
+# stopped it. Once the portfolio is written, a 'completed' record closes the run, with
+# the tickers that failed, and the next run starts a new journal, retrying them along
+# with the rest of the universe. Only a run that stopped before writing its portfolio
+# is resumed, so analyses are never reused beyond the run they were made in.
+
+import os
+import json
+from time import time
+
+class RunJournal:
+    """Append-only JSON lines journal of an analysis run."""
+
+    def __init__(self, path : str = 'journal.jsonl'):
+        self.path = path
+        self.records = []
+
+        try:
+            with open(path) as journal_file:
+                for line in journal_file:
+                    try:
+                        self.records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Last line cut short by a crash
+                        break
+        except FileNotFoundError:
+            pass
+
+        # Tickers that failed in the previous run, if it was completed
+        self.retry = []
+
+        # A completed run is not resumed
+        if self.records and self.records[-1]['stage'] == 'completed':
+            self.retry = self.records[-1].get('failed', [])
+            self.records = []
+            os.remove(path)
+
+    def record(self, ticker : str, stage : str, **data):
+        """Appends a record to the journal, makes sure it reaches the disk and returns it."""
+        record = {'ticker': ticker, 'stage': stage, 'time': time(), **data}
+        self.records.append(record)
+
+        with open(self.path, 'a') as journal_file:
+            journal_file.write(json.dumps(record) + '\n')
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+
+        return record
+
+    def latest(self, stage : str):
+        """Returns the latest record of every ticker that reached a stage, as
+           {ticker: record}."""
+        return {record['ticker']: record for record in self.records if record['stage'] == stage}
+
+    def failed(self):
+        """Returns the tickers whose latest record is a failure, as {ticker: error}."""
+        latest = {}
+        for record in self.records:
+            if record['ticker'] is not None:
+                latest[record['ticker']] = record
+        return {ticker: record['error'] for ticker, record in latest.items() if record['stage'] == 'failed'}
+
+    def complete(self, failed : list = ()):
+        """Closes the run, once every ticker was attempted. The next RunJournal opened
+           on the same path starts over, with the tickers that failed as its retry list."""
+        self.record(None, 'completed', failed=list(failed))
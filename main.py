@@ -7,159 +7,86 @@
 # has a 25 request per day limit in the free version, which will be pretty easily
 # exceeded by HedgeHog. I have implemented a check function that verifies every time
 # the API is called if the limit is reached, and it will raise a ConnectionRefusedError
-# if it is.
+# if it is. Requests throttled by the per-minute limit are retried after a while, and
+# once the daily limit is reached no more requests are sent until the next day.
+#
+# The run itself is done by pipeline.run; this file only reads its settings from the
+# command line (run 'python main.py --help' to list them), so HedgeHog can be run
+# from a scheduler without any input. The budget is asked for if it isn't given.
 
-import json
-from qualit import *
-from quant import *
-from scorecalc import *
-from tickers import *
-from apikeys import *
-from time import sleep
-
-# Startup splash screen
-print('╻    ╻   ┏━━━━━   ━━━━━┓   ┏━━━━━   ┏━━━━━      ╻    ╻   ┏━━━━┓   ┏━━━━━')
-print('┃    ┃   ┃         ┃   ┃   ┃        ┃           ┃    ┃   ┃    ┃   ┃     ')
-print('┣━━━━┫   ┣━━━━     ┃   ┃   ┃  ━━┓   ┣━━━━━      ┣━━━━┫   ┃    ┃   ┃  ━━┓')
-print('┃    ┃   ┃         ┃   ┃   ┃    ┃   ┃           ┃    ┃   ┃    ┃   ┃    ┃')
-print('╹    ╹   ┗━━━━━   ━━━━━┛   ┗━━━━┛   ┗━━━━━      ╹    ╹   ┗━━━━┛   ┗━━━━┛')
-
-# Get total investment budget from user
-print('')
-
-print('Enter your total investment budget: ', end='')
-
-total_budget = float(input())
-
-print('')
+import argparse
 
 test_set = ['AAPL', 'MSFT', 'NVDA', 'AMZN'] # Will be replaced by variable 'sp500' from 'tickers' module in full version
 
-# Will include the companies the algorithm has decided to buy
-cart = {}
-
-# Main decision-making loop. If you get errors in this part it is probably due to the two APIs used
-for company in test_set:
-    print(f'■ Currently Analysing: {company}')
-
-    scores = []
-
-    company_income_statement = get_income_statement(company, alphavantage_api_key)
-    company_balance_sheet = get_balance_sheet(company, alphavantage_api_key)
-
-    scores.append(liabilities_to_equity_score(company_balance_sheet))
-    print(f'Debt-to-Equity Ratio: {liabilities_to_equity(company_balance_sheet)}')
-    print(f'Debt-to-Equity Atrributed Score: {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(liabilities_to_capital_score(company_balance_sheet))
-    print(f'Debt-to-Capital Ratio: {liabilities_to_capital(company_balance_sheet)}')
-    print(f'Debt-to-Capital Atrributed Score: {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(assets_to_equity_score(company_balance_sheet)))
-    print(f'Assets-to-Equity Ratio: {assets_to_equity(company_balance_sheet)}')
-    print(f'Assets-to-Equity Atrributed Score: {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(debt_to_ebitda_score(company_balance_sheet, company_income_statement)))
-    print(f'Debt-to-EBITDA Ratio: {debt_to_ebitda(company_balance_sheet, company_income_statement)}')
-    print(f'Debt-to-EBITDA Atrributed Score: {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(quick_ratio_score(company_balance_sheet)))
-    print(f'Quick Ratio: {quick_ratio(company_balance_sheet)}')
-    print(f'Quick Ratio Atrributed Score: {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(current_ratio_score(company_balance_sheet)))
-    print(f'Current Ratio: {current_ratio(company_balance_sheet)}')
-    print(f'Current Ratio Atrributed Score: {scores[-1]}')
-
-    sleep(0.2)
-
-    status = ten_yr_operating_expenses_growth(company_income_statement)
-
-    if status != False:
-        scores.append(float(ten_yr_opex_growth_score(company_income_statement)))
-        print(f'10-Year Operating Expenses Growth: {status}')
-        print(f'10-Year Operating Expenses Growth Atrributed Score: {scores[-1]}')
-
-    # sleep(0.2)
+parser = argparse.ArgumentParser(description='Chooses a stock portfolio based on fundamental analysis and market sentiment.')
+parser.add_argument('budget', type=float, nargs='?', help='total investment budget (asked for if not given)')
+parser.add_argument('--universe', nargs='+', default=['test'],
+                    help="tickers to analyse, or 'test' (the test set), 'sp500' (the S&P 500) or 'sec' (every company of the SEC's company_tickers.json)")
+parser.add_argument('--output', default='portfolio.txt', help='file the portfolio is written to')
+# Request budgets of the API keys. The free AlphaVantage key allows 5 requests per
+# minute and the free Gemeni key 15; raise these if you have a premium key.
+parser.add_argument('--av-rpm', type=float, default=5, help='AlphaVantage requests per minute')
+parser.add_argument('--gemeni-rpm', type=float, default=15, help='Gemeni requests per minute')
+parser.add_argument('--workers', type=int, default=8, help='concurrent AlphaVantage fetches (companies rescored at once with --watch)')
+parser.add_argument('--batch-size', type=int, default=10, help='companies per qualitative Gemeni request')
+parser.add_argument('--gemeni-concurrency', type=int, default=8, help='concurrent Gemeni requests')
+parser.add_argument('--gemeni-timeout', type=float, default=60, help='seconds a Gemeni request may take before it is abandoned')
+parser.add_argument('--daily-budget', type=int, help='daily AlphaVantage request budget (see planner.py)')
+parser.add_argument('--cache-only', action='store_true', help='run from the statements cached by previous runs only')
+parser.add_argument('--history', default='history.sqlite', help='database the ratios, scores and allocations of the run are recorded in (see history.py)')
+parser.add_argument('--report', default='run_report.json', help='JSON file the run metrics are written to')
+parser.add_argument('--prometheus', default='run_metrics.prom', help='Prometheus file the run metrics are written to')
+parser.add_argument('--profile', help='file to write cProfile statistics of the run to')
+parser.add_argument('--watch', type=float, metavar='MINUTES',
+                    help='keep running, checking for new reports every MINUTES minutes and rescoring only the companies that published one (see daemon.py)')
+parser.add_argument('--quiet', action='store_true', help='skip the splash screen')
+args = parser.parse_args()
+
+# The monitoring daemon rescores one company at a time from fresh statements and keeps
+# no run history or metrics files, so these options don't apply to it
+if args.watch is not None:
+    ignored = [option for option in ('batch_size', 'cache_only', 'history', 'report', 'prometheus', 'profile')
+               if getattr(args, option) != parser.get_default(option)]
+    if ignored:
+        parser.error('--watch cannot be combined with ' + ', '.join('--' + option.replace('_', '-') for option in ignored))
 
-    status = ten_yr_assets_growth(company_balance_sheet)
-    if status != False:
-        scores.append(float(ten_yr_assets_growth_score(company_balance_sheet)))
-        print(f'10-Year Assets Growth: {status}')
-        print(f'10-Year Assets Growth Atrributed Score: {scores[-1]}')
-
-    # sleep(0.2)
-
-    status = ten_yr_liabilities_growth(company_balance_sheet)
-    if status != False:
-        scores.append(float(ten_yr_liabilities_growth_score(company_balance_sheet)))
-        print(f'10-Year Liabilities Growth: {status}')
-        print(f'10-Year Liabilities Growth Atrributed Score: {scores[-1]}')
-
-    # sleep(0.2)
-
-    # status = ten_yr_share_count_growth(company_balance_sheet)
-
-    # if status != False:
-    #   scores.append(float(ten_yr_share_count_growth_score(company_balance_sheet)))
-    #   print(f'10-Year Share Count Growth: {status}')
-    #   print(f'10-Year Share Count Growth Atrributed Score: {scores[-1]}')
-
-    scores.append(float(analyse_public_sentiment_company(company)))
-    print(f'Public Sentiment Towards the Company {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(analyse_public_sentiment_leadership(company)))
-    print(f'Public Sentiment Towards the Company\'s Leadership {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(analyse_public_sentiment_sector(company)))
-    print(f'Public Sentiment Towards the Company\'s Industry Sector {scores[-1]}')
-
-    sleep(0.2)
-
-    scores.append(float(analyse_esg_and_sustainability(company)))
-    print(f'The Company\'s ESG and Sustainability Efforts {scores[-1]}')
-
-    sleep(0.2)
-
-    scores_avg = sum(scores) / len(scores)
-    print(f'Company\'s Average Score {scores_avg}')
-
-    sleep(0.2)
-
-    cart[company] = scores_avg
-
-    print(' ')
-    sleep(3)
-
-# Sorts the cart by score values
-sorted_cart = {key: value for key, 
-               value in sorted(cart.items(), 
-                               key=lambda item: item[1])}
-
-sorted_cart_selection = dict(list(sorted_cart.items())[len(sorted_cart) // 2:])
-
-# Writes to portfolio file
-portfolio_file = open('portfolio.txt', 'w')
-
-print('WRITING ANALYSIS RESULTS TO "portfolio.txt"')
-for pick in sorted_cart_selection:
-    line = f"Buy {(sorted_cart_selection[pick]/sum(list(sorted_cart_selection.values()))) * (total_budget):.2f}$ of {pick} shares\n"
-    portfolio_file.write(line)
-
-print('File write completed. Exiting program...')
+# Startup splash screen
+if not args.quiet:
+    print('╻    ╻   ┏━━━━━   ━━━━━┓   ┏━━━━━   ┏━━━━━      ╻    ╻   ┏━━━━┓   ┏━━━━━')
+    print('┃    ┃   ┃         ┃   ┃   ┃        ┃           ┃    ┃   ┃    ┃   ┃     ')
+    print('┣━━━━┫   ┣━━━━     ┃   ┃   ┃  ━━┓   ┣━━━━━      ┣━━━━┫   ┃    ┃   ┃  ━━┓')
+    print('┃    ┃   ┃         ┃   ┃   ┃    ┃   ┃           ┃    ┃   ┃    ┃   ┃    ┃')
+    print('╹    ╹   ┗━━━━━   ━━━━━┛   ┗━━━━┛   ┗━━━━━      ╹    ╹   ┗━━━━┛   ┗━━━━┛')
+    print('')
 
-portfolio_file.close()
+# Get total investment budget from user
+if args.budget is None:
+    print('Enter your total investment budget: ', end='')
+    args.budget = float(input())
+    print('')
+
+# Imported only now, so that '--help' answers right away
+from pipeline import run
+from tickers import sp500, load_sec_tickers
+
+universes = {'test': test_set, 'sp500': sp500}
+if 'sec' in args.universe:
+    universes['sec'] = list(load_sec_tickers())
+universe = [ticker for name in args.universe for ticker in universes.get(name, [name])]
+
+if args.watch is not None:
+    import asyncio
+    from daemon import watch
+
+    asyncio.run(watch(args.budget, universe, interval=args.watch * 60, av_requests_per_minute=args.av_rpm,
+                      gemeni_requests_per_minute=args.gemeni_rpm, workers=args.workers, portfolio_path=args.output,
+                      av_daily_budget=args.daily_budget, gemeni_concurrency=args.gemeni_concurrency,
+                      gemeni_timeout=args.gemeni_timeout))
+else:
+    run(args.budget, universe, portfolio_path=args.output, av_requests_per_minute=args.av_rpm,
+        gemeni_requests_per_minute=args.gemeni_rpm, fetch_workers=args.workers, qualit_batch_size=args.batch_size,
+        gemeni_concurrency=args.gemeni_concurrency, gemeni_timeout=args.gemeni_timeout, av_daily_budget=args.daily_budget,
+        cache_only=args.cache_only, history_path=args.history, report_path=args.report, prometheus_path=args.prometheus,
+        profile_path=args.profile)
+
+print('Exiting program...')
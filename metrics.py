@@ -0,0 +1,183 @@
+# The code in this file records where the time of an analysis run goes. The hot paths
+# of HedgeHog (AlphaVantage requests, statement fetching, Gemeni requests, ratio and
+# score calculations, rate limiter waits, portfolio selection) are wrapped with the
+# instrumented decorator or the timed context manager, which feed a single metrics
+# registry with counters, timers and latency histograms, per stage and per ticker.
+# At the end of a run, the registry is exported as a JSON report and as a Prometheus
+# text-format file. A cProfile hook is available for finer-grained investigations.
+
+import json
+import cProfile
+import threading
+from time import perf_counter, time
+from functools import wraps
+from inspect import iscoroutinefunction
+from contextlib import contextmanager
+
+# Upper bounds (in seconds) of the latency histogram buckets
+histogram_buckets = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+def ticker_of(args : tuple, index : int = 0):
+    """Finds the ticker an instrumented call is about: its argument at index if it is
+       a string, or the ticker of that argument (e.g. a FinancialStatements). None if
+       index is None, for functions whose calls aren't about a ticker."""
+    if index is None or len(args) <= index:
+        return None
+    if isinstance(args[index], str):
+        return args[index]
+    return getattr(args[index], 'ticker', None)
+
+def percentile(sorted_samples : list, q : float):
+    """Returns the q-th percentile of a sorted list of samples (nearest rank)."""
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(q / 100 * len(sorted_samples)))]
+
+class Metrics:
+    """Thread-safe registry of the counters, timers and histograms of a run."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clears every metric and restarts the run clock."""
+        with self.lock:
+            self.started = time()
+            self.counters = {}
+            self.samples = {}
+            self.histograms = {}
+            self.ticker_timers = {}
+
+    def count(self, name : str, ticker : str = None, amount : float = 1):
+        """Increments a counter, for a ticker if one is given."""
+        with self.lock:
+            self.counters[(name, ticker)] = self.counters.get((name, ticker), 0) + amount
+
+    def observe(self, stage : str, seconds : float, ticker : str = None):
+        """Records the duration of a stage, for a ticker if one is given."""
+        with self.lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+            buckets = self.histograms.setdefault(stage, [0] * len(histogram_buckets))
+            for index, bound in enumerate(histogram_buckets):
+                if seconds <= bound:
+                    buckets[index] += 1
+                    break
+
+            if ticker is not None:
+                count, total = self.ticker_timers.get((stage, ticker), (0, 0.0))
+                self.ticker_timers[(stage, ticker)] = (count + 1, total + seconds)
+
+    @contextmanager
+    def timed(self, stage : str, ticker : str = None):
+        """Context manager recording the time spent in its block as a stage."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, perf_counter() - start, ticker)
+
+    def report(self):
+        """Returns every metric as a JSON-serializable dictionary."""
+        with self.lock:
+            stages = {}
+            for stage, samples in self.samples.items():
+                ordered = sorted(samples)
+                stages[stage] = {'count': len(ordered), 'total_s': sum(ordered), 'min_s': ordered[0], 'max_s': ordered[-1],
+                                 **{f'p{q}_s': percentile(ordered, q) for q in (50, 90, 99)}}
+
+            tickers = {}
+            for (stage, ticker), (count, total) in self.ticker_timers.items():
+                tickers.setdefault(ticker, {'stages': {}, 'counters': {}})['stages'][stage] = {'count': count, 'total_s': total}
+            for (name, ticker), value in self.counters.items():
+                if ticker is not None:
+                    tickers.setdefault(ticker, {'stages': {}, 'counters': {}})['counters'][name] = value
+
+            counters = {}
+            for (name, ticker), value in self.counters.items():
+                counters[name] = counters.get(name, 0) + value
+
+            return {'started': self.started, 'duration_s': time() - self.started,
+                    'counters': counters, 'stages': stages, 'tickers': tickers}
+
+    def export_json(self, path : str):
+        """Writes the JSON run report."""
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=4)
+
+    def export_prometheus(self, path : str):
+        """Writes the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            lines = ['# HELP hedgehog_events_total Events counted during the run.',
+                     '# TYPE hedgehog_events_total counter']
+            for (name, ticker), value in sorted(self.counters.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+                labels = f'name="{name}"' + (f',ticker="{ticker}"' if ticker is not None else '')
+                lines.append(f'hedgehog_events_total{{{labels}}} {value}')
+
+            lines += ['# HELP hedgehog_stage_seconds Time spent in each stage of the run.',
+                      '# TYPE hedgehog_stage_seconds histogram']
+            for stage, buckets in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(histogram_buckets, buckets):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'hedgehog_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'hedgehog_stage_seconds_sum{{stage="{stage}"}} {sum(self.samples[stage])}')
+                lines.append(f'hedgehog_stage_seconds_count{{stage="{stage}"}} {len(self.samples[stage])}')
+
+            lines += ['# HELP hedgehog_ticker_stage_seconds Time spent in each stage, per ticker.',
+                      '# TYPE hedgehog_ticker_stage_seconds summary']
+            for (stage, ticker), (count, total) in sorted(self.ticker_timers.items()):
+                lines.append(f'hedgehog_ticker_stage_seconds_sum{{stage="{stage}",ticker="{ticker}"}} {total}')
+                lines.append(f'hedgehog_ticker_stage_seconds_count{{stage="{stage}",ticker="{ticker}"}} {count}')
+
+        with open(path, 'w') as metrics_file:
+            metrics_file.write('\n'.join(lines) + '\n')
+
+# Registry every module of HedgeHog reports to
+metrics = Metrics()
+
+def instrumented(stage : str = None, ticker_arg : int = 0):
+    """Decorator timing every call of a function as a stage (the function's name by
+       default), for the ticker the call is about: its positional argument ticker_arg
+       (see ticker_of), or none if ticker_arg is None."""
+    def decorator(function):
+        name = stage or function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metrics.observe(name, perf_counter() - start, ticker_of(args, ticker_arg))
+
+        # Coroutines are timed until they finish, not until they are created
+        @wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                metrics.observe(name, perf_counter() - start, ticker_of(args, ticker_arg))
+
+        return async_wrapper if iscoroutinefunction(function) else wrapper
+    return decorator
+
+profiler = None
+
+def start_profiling():
+    """Starts profiling the run with cProfile."""
+    global profiler
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+def stop_profiling(path : str):
+    """Stops profiling and writes the statistics to path, to be read with pstats or
+       a viewer like snakeviz."""
+    global profiler
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(path)
+        profiler = None
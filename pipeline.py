@@ -0,0 +1,282 @@
+# The code in this file runs HedgeHog's whole decision-making process: fetching the
+# financial statements, the qualitative analysis, the scoring and the portfolio
+# selection. It is what main.py runs, exposed as a function so that HedgeHog can be
+# driven from a scheduler or another program. Importing it has no side effects: the
+# API keys are only read and the API clients only created when a run starts.
+
+import asyncio
+import numpy as np
+from quant import *
+from scorecalc import ratio_matrix, score_universe, load_score_params
+from qualit import QualitativeExecutor, qualit_cache, gemeni_model
+from fetch import fetch_universe
+from journal import RunJournal
+from planner import plan_refreshes, refresh_pairs, statement_functions
+from ranking import ScoreIndex, read_portfolio, write_portfolio, portfolio_diff, describe_diff
+from store import FundamentalsStore
+from history import RunHistory
+from metrics import metrics, start_profiling, stop_profiling
+
+# Quantitative metrics, as (display name, ratio function, scorecalc metric). Metrics
+# that cannot be calculated for a company are left out of its average.
+quant_metrics = [
+    ('Debt-to-Equity Ratio', liabilities_to_equity, 'liabilities_to_equity'),
+    ('Debt-to-Capital Ratio', liabilities_to_capital, 'liabilities_to_capital'),
+    ('Assets-to-Equity Ratio', assets_to_equity, 'assets_to_equity'),
+    ('Debt-to-EBITDA Ratio', debt_to_ebitda, 'debt_to_ebitda'),
+    ('Quick Ratio', quick_ratio, 'quick_ratio'),
+    ('Current Ratio', current_ratio, 'current_ratio'),
+    ('10-Year Operating Expenses Growth', ten_yr_operating_expenses_growth, 'ten_yr_opex_growth'),
+    ('10-Year Assets Growth', ten_yr_assets_growth, 'ten_yr_assets_growth'),
+    ('10-Year Liabilities Growth', ten_yr_liabilities_growth, 'ten_yr_liabilities_growth'),
+    # ('10-Year Share Count Growth', ten_yr_share_count_growth, 'ten_yr_share_count_growth'),
+]
+
+# Qualitative scores, as (display name, qualit kind)
+qualit_metrics = [
+    ('Public Sentiment Towards the Company', 'company'),
+    ('Public Sentiment Towards the Company\'s Leadership', 'leadership'),
+    ('Public Sentiment Towards the Company\'s Industry Sector', 'sector'),
+    ('The Company\'s ESG and Sustainability Efforts', 'esg'),
+]
+
+async def fetch_and_analyse(companies : list, av_api_key : str, executor : QualitativeExecutor, batch_size : int,
+                            fetch_options : dict):
+    """Fetches the statements of companies (see fetch.fetch_universe) while their
+       qualitative analysis runs, since neither depends on the other. Returns the
+       statements and fetch errors, then the qualitative scores and analysis errors."""
+    (statements, fetch_errors), (scores, qualit_errors) = await asyncio.gather(
+        asyncio.to_thread(fetch_universe, companies, av_api_key, **fetch_options),
+        executor.qualitative_scores(companies, batch_size))
+
+    return statements, fetch_errors, scores, qualit_errors
+
+def run(total_budget : float, universe : list, portfolio_path : str = 'portfolio.txt', av_api_key : str = None,
+        gemeni_api_key : str = None, av_requests_per_minute : float = 5, gemeni_requests_per_minute : float = 15,
+        fetch_workers : int = 8, qualit_batch_size : int = 10, gemeni_concurrency : int = 8, gemeni_timeout : float = 60,
+        av_daily_budget : int = None, cache_only : bool = False, score_params_path : str = 'score_params.json',
+        journal_path : str = 'journal.jsonl', score_index_path : str = 'score_index.json', store_path : str = 'store',
+        history_path : str = 'history.sqlite', report_path : str = 'run_report.json', prometheus_path : str = 'run_metrics.prom', profile_path : str = None):
+    """Analyses a universe of tickers and writes the portfolio to buy with total_budget
+       to portfolio_path. The API keys default to the ones stored in apikeys.py. See
+       main.py for the meaning of the other parameters. Returns a dictionary with the
+       portfolio ({ticker: amount}), its differences with the previous one (see
+       ranking.portfolio_diff), the average score of every company scored and the
+       companies that could not be analysed ({ticker: error})."""
+    if av_api_key is None and not cache_only:
+        from apikeys import alphavantage_api_key as av_api_key
+
+    if gemeni_api_key is not None:
+        gemeni_model(gemeni_api_key)
+
+    statement_cache.offline = cache_only
+    request_ledger.limit = av_daily_budget
+
+    # Calibrated distribution parameters (see calibrate.py), checked before anything is fetched
+    if load_score_params(score_params_path):
+        print(f'Scoring with the distribution parameters of "{score_params_path}"')
+
+    if profile_path is not None:
+        start_profiling()
+
+    # Progress of the run is journaled, so that if it stops partway through, running the
+    # program again resumes it: companies already analysed are skipped and failed ones retried
+    journal = RunJournal(journal_path)
+
+    if journal.retry:
+        print(f'Retrying {len(journal.retry)} companies that failed in the previous run: {", ".join(journal.retry)}')
+        print('')
+
+    analysed = {company: record for company, record in journal.latest('analysed').items() if company in universe}
+    pending = [company for company in universe if company not in analysed]
+
+    if analysed:
+        print(f'Resuming previous run: {len(analysed)} companies already analysed, {len(pending)} left')
+        print('')
+
+    refresh = None
+
+    # Plans which statements to refresh within the daily budget
+    if av_daily_budget is not None:
+        # The budget is shared by every run of the day, and enforced on every request
+        # sent (retries included)
+        spent_today = request_ledger.spent(av_api_key)
+
+        planned, deferred = plan_refreshes(pending, max(av_daily_budget - spent_today, 0))
+        refresh = refresh_pairs(planned)
+
+        print(f'Daily budget: {spent_today} of {av_daily_budget} requests already spent today')
+        print(f'Refresh plan: {len(planned)} companies refreshed, {len(deferred)} deferred')
+
+        if deferred and not planned:
+            print('WARNING: THE REQUESTS LEFT IN THE DAILY BUDGET ARE TOO FEW TO REFRESH ANY COMPANY')
+
+        # Earnings only serve to plan the next refreshes
+        fetch_universe([company for company in planned if 'EARNINGS' in planned[company]], av_api_key,
+                       functions=('EARNINGS',), requests_per_minute=av_requests_per_minute,
+                       max_workers=fetch_workers, refresh=refresh)
+
+        # Companies with statements that were never fetched and aren't planned can't be
+        # analysed this time
+        pending = [company for company in pending
+                   if all((company, function) in refresh or statement_cache.load(company, function) is not None
+                          for function in statement_functions)]
+
+    # Fetches the statements of every pending company concurrently, within the budget,
+    # and asks for their qualitative scores at the same time, skipping those cached by
+    # previous runs. Sector sentiment is only analysed once per sector
+    print('Fetching financial statements and running qualitative analysis...')
+    executor = QualitativeExecutor(gemeni_concurrency, gemeni_requests_per_minute, gemeni_timeout)
+    universe_statements, fetch_errors, qualit_scores, qualit_errors = asyncio.run(fetch_and_analyse(
+        pending, av_api_key, executor, qualit_batch_size,
+        {'requests_per_minute': av_requests_per_minute, 'max_workers': fetch_workers, 'refresh': refresh}))
+
+    for company, error in fetch_errors.items():
+        print(f'Could not fetch the statements of {company}: {error}')
+        journal.record(company, 'failed', error=repr(error))
+
+    for company in universe_statements:
+        journal.record(company, 'fetched')
+
+    for company, error in qualit_errors.items():
+        if company in universe_statements:
+            print(f'Could not analyse {company}: {error}')
+            journal.record(company, 'failed', error=repr(error))
+
+    cache_stats = statement_cache.stats()
+    print(f'Statement cache: {cache_stats["hits"]} hits, {cache_stats["misses"]} misses')
+
+    qualit_stats = qualit_cache.stats()
+    print(f'Qualitative cache: {qualit_stats["hits"]} hits, {qualit_stats["misses"]} misses')
+
+    print('')
+
+    fetched = list(universe_statements)
+
+    # Statements analysed this run, added to the fundamentals store at the end of the loop
+    analysed_statements = []
+
+    # Main analysis loop. If you get errors in this part it is probably due to the two APIs used
+    for company in fetched:
+        if company not in qualit_scores:
+            continue
+
+        print(f'■ Currently Analysing: {company}')
+
+        try:
+            company_statements = FinancialStatements.from_reports(universe_statements[company]['BALANCE_SHEET'],
+                                                                  universe_statements[company]['INCOME_STATEMENT'])
+            company_statements.ticker = company
+            ratios = [ratio_function(company_statements) for _, ratio_function, _ in quant_metrics]
+        except (KeyError, ValueError) as error:
+            print(f'Could not analyse the statements of {company}: {error!r}')
+            journal.record(company, 'failed', error=repr(error))
+            print(' ')
+            continue
+
+        for (label, _, _), ratio_val in zip(quant_metrics, ratios):
+            print(f'{label}: {ratio_val}')
+
+        qualit = [qualit_scores[company][kind] for _, kind in qualit_metrics]
+
+        for (label, _), score in zip(qualit_metrics, qualit):
+            print(f'{label} {score}')
+
+        analysed[company] = journal.record(company, 'analysed', ratios=ratios, qualit=qualit)
+        analysed_statements.append(company_statements)
+
+        print(' ')
+
+    FundamentalsStore(store_path).append(analysed_statements)
+
+    failed = {company: error for company, error in journal.failed().items() if company in universe}
+    if failed:
+        print(f'{len(failed)} companies could not be analysed and are left out: {", ".join(failed)}')
+        print('They will be retried by the next run.')
+        print('')
+
+    # Scores every analysed company at once, from the journal. Ratios that failed to
+    # calculate are left out of the averages
+    companies = [company for company in universe if company in analysed]
+
+    if companies:
+        ratios = ratio_matrix([analysed[company]['ratios'] for company in companies])
+        qualit = np.array([analysed[company]['qualit'] for company in companies], dtype=float)
+        scores, scores_avg = score_universe(ratios, [metric for _, _, metric in quant_metrics], qualit,
+                                            [qualit_cache.get('sector_of', company) for company in companies])
+
+    # Will include the companies the algorithm has decided to buy
+    cart = {}
+
+    for index, company in enumerate(companies):
+        print(f'■ Scores of {company}')
+
+        for (label, _, _), score in zip(quant_metrics, scores[index]):
+            if not np.isnan(score):
+                print(f'{label} Atrributed Score: {score}')
+
+        print(f'Company\'s Average Score {scores_avg[index]}')
+        print(' ')
+
+        journal.record(company, 'scored', scores=[None if np.isnan(score) else float(score) for score in scores[index]],
+                       average=None if np.isnan(scores_avg[index]) else float(scores_avg[index]))
+
+        if not np.isnan(scores_avg[index]):
+            cart[company] = float(scores_avg[index])
+
+    previous_portfolio = read_portfolio(portfolio_path)
+
+    if companies:
+        # Updates the ranked score index with the companies whose score changed since the
+        # last run, and drops the ones that left the universe or no longer average to a
+        # score. Companies that could not be analysed this time keep their last score, like
+        # the ones not rescored. The companies above the median are then bought, weighted
+        # by their score
+        with metrics.timed('selection'):
+            score_index = ScoreIndex(score_index_path)
+            dropped = {company: None for company in score_index.scores if company not in cart and
+                       (company not in universe or company in companies)}
+            changed = score_index.update({**cart, **dropped})
+            selection = score_index.select()
+            score_index.save()
+
+        print(f'Score index: {changed} companies updated, {len(score_index)} ranked')
+        print('')
+
+        portfolio = {pick: round(weight * total_budget, 2) for pick, weight in selection}
+
+        print(f'WRITING ANALYSIS RESULTS TO "{portfolio_path}"')
+        write_portfolio(portfolio_path, portfolio)
+    else:
+        # Most likely an outage of one of the APIs: the index and the last portfolio are
+        # worth more than an empty one
+        print(f'WARNING: NO COMPANY COULD BE SCORED, "{portfolio_path}" AND THE SCORE INDEX ARE LEFT AS THEY WERE')
+        portfolio = previous_portfolio
+
+    # Changes since the previous portfolio
+    diff = portfolio_diff(previous_portfolio, portfolio)
+    for line in describe_diff(diff):
+        print(line)
+
+    # Every ratio, score and allocation of the run is kept in the run history
+    if companies:
+        history = RunHistory(history_path)
+        run_number = history.record_run(companies, [metric for _, _, metric in quant_metrics] + [kind for _, kind in qualit_metrics],
+                                        np.hstack([ratios, qualit]), scores, scores_avg, portfolio, total_budget)
+        history.close()
+        print(f'Run recorded in "{history_path}" as run #{run_number}')
+
+    # Every company was attempted, so the run is closed even if some failed: the next run
+    # starts over rather than reusing this run's analyses, and retries the failed ones
+    journal.complete(failed)
+
+    print('File write completed.')
+
+    if profile_path is not None:
+        stop_profiling(profile_path)
+
+    metrics.export_json(report_path)
+    metrics.export_prometheus(prometheus_path)
+    print(f'Run metrics written to "{report_path}" and "{prometheus_path}".')
+
+    return {'portfolio': portfolio, 'diff': diff, 'scores': cart, 'failed': failed}
@@ -0,0 +1,108 @@
+# The code in this file plans which AlphaVantage statements to refresh when the API key
+# has a daily request budget. Rather than going through the universe in a fixed order
+# (which refreshes the first tickers over and over while the last ones never are), it
+# looks at when each statement was last fetched and when the company's next annual
+# report is likely to be out, and spends the budget where new data is most likely.
+# The expected filing date is estimated from the company's EARNINGS data (see
+# quant.get_earnings): the delay between the end of its last fiscal year and the date
+# the results were reported is assumed to repeat the following year.
+
+from time import time
+from datetime import datetime
+from cache import DAY, filing_lag
+from quant import statement_cache
+
+statement_functions = ('INCOME_STATEMENT', 'BALANCE_SHEET')
+
+def parse_date(date : str):
+    """Converts a 'YYYY-MM-DD' date to a timestamp."""
+    return datetime.strptime(date, '%Y-%m-%d').timestamp()
+
+def company_filing_lag(earnings : dict):
+    """Returns the time (in seconds) a company took to report its last fiscal year,
+       from its EARNINGS data, or None if it cannot be told."""
+    annual = earnings.get('annualEarnings') or []
+    if not annual:
+        return None
+
+    for quarter in earnings.get('quarterlyEarnings') or []:
+        if quarter.get('fiscalDateEnding') == annual[0]['fiscalDateEnding'] and quarter.get('reportedDate', 'None') != 'None':
+            return parse_date(quarter['reportedDate']) - parse_date(annual[0]['fiscalDateEnding'])
+
+    return None
+
+def expected_filing(fiscal_period : str, lag : float = None):
+    """Returns the timestamp at which the annual report following the fiscal year
+       ending on fiscal_period is expected, lag being the company's own filing lag."""
+    return parse_date(fiscal_period) + 365 * DAY + (filing_lag if lag is None else lag)
+
+def refresh_value(entry : dict, function : str, lag : float = None, now : float = None):
+    """Rates how worthwhile refreshing a cached statement is. 0 means the cached copy
+       is still good; never fetched statements rate 3, statements for which a newer
+       report should be out rate 2 to 3 (the longer overdue, the higher), and ones
+       whose TTL ran out rate 1 to 2. EARNINGS rate at most half of that, since they
+       are only needed for planning."""
+    now = time() if now is None else now
+    weight = 0.5 if function == 'EARNINGS' else 1.0
+
+    if entry is None:
+        return 3 * weight
+
+    if function != 'EARNINGS' and entry['fiscal_period'] is not None:
+        expected = expected_filing(entry['fiscal_period'], lag)
+        if now >= expected and entry['fetched_at'] < expected:
+            return (2 + min((now - expected) / (365 * DAY), 1)) * weight
+
+    age = (now - entry['fetched_at']) / statement_cache.ttls.get(function, DAY)
+    if age >= 1:
+        return (1 + min(age - 1, 1)) * weight
+
+    return 0.0
+
+def plan_refreshes(tickers : list, daily_budget : int, functions : tuple = statement_functions, now : float = None):
+    """Chooses which statements of the universe to refresh with the requests left in
+       the daily budget. Tickers are refreshed as a whole (every due function at once,
+       EARNINGS included), highest value per request first. When a ticker's whole
+       refresh doesn't fit, its statements are refreshed without the EARNINGS if they
+       fit on their own. Returns the planned refreshes and the deferred ones, both as
+       {ticker: [functions]}."""
+    now = time() if now is None else now
+    candidates = []
+
+    for ticker in tickers:
+        earnings_entry = statement_cache.load(ticker, 'EARNINGS')
+        lag = None if earnings_entry is None else company_filing_lag(earnings_entry['data'])
+
+        values = {function: refresh_value(statement_cache.load(ticker, function), function, lag, now)
+                  for function in (*functions, 'EARNINGS')}
+        due = [function for function, value in values.items() if value > 0]
+
+        if due:
+            candidates.append((sum(values[function] for function in due) / len(due), ticker, due))
+
+    candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+    planned = {}
+    deferred = {}
+    remaining = daily_budget
+
+    for _, ticker, due in candidates:
+        statements = [function for function in due if function != 'EARNINGS']
+
+        if len(due) <= remaining:
+            planned[ticker] = due
+        elif statements and len(statements) <= remaining:
+            planned[ticker] = statements
+            deferred[ticker] = ['EARNINGS']
+        else:
+            deferred[ticker] = due
+            continue
+
+        remaining -= len(planned[ticker])
+
+    return planned, deferred
+
+def refresh_pairs(plan : dict):
+    """Converts a plan of the form {ticker: [functions]} into a set of (ticker, function)
+       pairs, as taken by fetch.fetch_universe."""
+    return {(ticker, function) for ticker, functions in plan.items() for function in functions}
@@ -2,28 +2,325 @@
 # choices. This code uses the Google Gemeni API, which is free. To use it, go to the
 # Google AI Studio website (https://aistudio.google.com) and claim an API key. Then,
 # create a file named 'apikeys.py' and store your API key as a string in a variable
-# called 'gemeni_api_key'. The file is in the .gitignore
+# called 'gemeni_api_key'. The file is in the .gitignore. The Gemeni client is only
+# created (and the SDK only imported) the first time it is needed. Besides the single-question
+# functions, QualitativeExecutor asks for all of the scores of several companies in one
+# structured (JSON) request, which saves most of the Gemeni calls, and only for the
+# scores missing from the qualitative cache, with sector sentiment analysed once per
+# sector rather than once per company. It uses the SDK's asynchronous requests, many
+# of them at once (within the requests per minute limit), so that the latency of each
+# Gemeni call doesn't add up across the universe. Every request is given a deadline,
+# and companies whose requests fail or time out are left out rather than stopping the
+# run. qualitative_scores runs it from synchronous code.
 
+import re
 import json
-import google.generativeai as genai
-from apikeys import gemeni_api_key
+import asyncio
+from cache import QualitativeCache
+from tickers import gics_sectors
+from fetch import TokenBucket
+from metrics import metrics, instrumented
 
-genai.configure(api_key=gemeni_api_key)
+# Gemeni model, created by gemeni_model on first use
+gemeni = None
 
-gemeni = genai.GenerativeModel("gemini-1.5-flash")
+def gemeni_model(api_key : str = None):
+    """Returns the Gemeni model, configuring the SDK with api_key (by default the one
+       stored in apikeys.py) the first time it is called."""
+    global gemeni
+    if gemeni is None:
+        import google.generativeai as genai
 
+        if api_key is None:
+            from apikeys import gemeni_api_key as api_key
+
+        genai.configure(api_key=api_key)
+        gemeni = genai.GenerativeModel("gemini-1.5-flash")
+
+    return gemeni
+
+# Scores and sector classifications are reused across runs until their TTL runs out
+qualit_cache = QualitativeCache()
+
+# Numbers in a free-text reply, and mentions of the 0 to 1 scale that are not the score
+number_pattern = re.compile(r'(?<![\w.])(\d*\.?\d+)\s*(%|(?:/|out of)\s*(?:100|10)\b)?', re.IGNORECASE)
+scale_pattern = re.compile(r'\b0\s*(?:to|and|-|–)\s*1(?:\.0+)?\b|(?:/|out of)\s*1(?:\.0+)?\b', re.IGNORECASE)
+
+def parse_score(text : str):
+    """Returns the score between 0 and 1 in a free-text reply, even a verbose one
+       (e.g. 'Score: 0.7 on a scale from 0 to 1', '70%', '7/10'). The first number between 0
+       and 1 that isn't part of the scale is taken. Raises a ValueError if there is none."""
+    for match in number_pattern.finditer(scale_pattern.sub(' ', text)):
+        scale = match.group(2) or ''
+        score = float(match.group(1)) / (100 if scale == '%' or scale.endswith('100') else 10 if scale else 1)
+        if 0 <= score <= 1:
+            return score
+
+    raise ValueError(f"NO SCORE BETWEEN 0 AND 1 IN GEMENI REPLY: {text!r}")
+
+@instrumented()
 def analyse_public_sentiment_company(ticker : str):
-    response = gemeni.generate_content(f"Analyse the general sentiment towards the brand image of the company whose ticker is {ticker}. YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE COMPANY IS VERY HATED) AND 1 (= THE COMPANY IS VERY LOVED). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. If the company has encountered large scandals or lawsuits in the past year this score should be low. Recent news should have a noticeable impact on this score.")
-    return response.text.strip()
+    response = gemeni_model().generate_content(f"Analyse the general sentiment towards the brand image of the company whose ticker is {ticker}. YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE COMPANY IS VERY HATED) AND 1 (= THE COMPANY IS VERY LOVED). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. If the company has encountered large scandals or lawsuits in the past year this score should be low. Recent news should have a noticeable impact on this score.")
+    return parse_score(response.text)
 
+@instrumented()
 def analyse_public_sentiment_leadership(ticker : str):
-    response = gemeni.generate_content(f"Analyse the general sentiment towards the leadership (MOST especially the CEO) of the company whose ticker is {ticker}. YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE LEADERSHIP IS VERY HATED) AND 1 (= THE LEADERSHIP IS VERY LOVED). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. If the CEO or other high management has been involved in many scandals this score should be low.")
-    return response.text.strip()
+    response = gemeni_model().generate_content(f"Analyse the general sentiment towards the leadership (MOST especially the CEO) of the company whose ticker is {ticker}. YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE LEADERSHIP IS VERY HATED) AND 1 (= THE LEADERSHIP IS VERY LOVED). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. If the CEO or other high management has been involved in many scandals this score should be low.")
+    return parse_score(response.text)
 
+@instrumented()
 def analyse_public_sentiment_sector(ticker : str):
-    response = gemeni.generate_content(f"Analyse the general sentiment towards the industry sector of the company whose ticker is {ticker}. YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE SECTOR IS VERY HATED) AND 1 (= THE SECTOR IS VERY LOVED). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. Analyse the sector independently from the company itself. If the sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.")
-    return response.text.strip()
+    response = gemeni_model().generate_content(f"Analyse the general sentiment towards the industry sector of the company whose ticker is {ticker}. YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE SECTOR IS VERY HATED) AND 1 (= THE SECTOR IS VERY LOVED). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. Analyse the sector independently from the company itself. If the sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.")
+    return parse_score(response.text)
 
+@instrumented()
 def analyse_esg_and_sustainability(ticker : str):
-    response = gemeni.generate_content(f"How enviornmentally and morally responsible is the company whose ticker is {ticker}? Are they good with ESG? YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE COMPANY IS VERY IRRESPONSIBLE/IMMORAL) AND 1 (= THE COMPANY IS VERY RESPONSIBLE). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. If a company's operation sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.")
-    return response.text.strip()
+    response = gemeni_model().generate_content(f"How enviornmentally and morally responsible is the company whose ticker is {ticker}? Are they good with ESG? YOUR RESPONSE SHOULD ONLY INCLUDE A NUMBER BETWEEN 0 (= THE COMPANY IS VERY IRRESPONSIBLE/IMMORAL) AND 1 (= THE COMPANY IS VERY RESPONSIBLE). The score should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. If a company's operation sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.")
+    return parse_score(response.text)
+
+# Questions asked in the structured qualitative analysis, one per score. Each score is
+# a number between 0 and 1, following the same guidelines as the functions above.
+qualit_questions = {
+    'company': "the general sentiment towards the brand image of the company (0 = THE COMPANY IS VERY HATED, 1 = THE COMPANY IS VERY LOVED). If the company has encountered large scandals or lawsuits in the past year this score should be low. Recent news should have a noticeable impact on this score.",
+    'leadership': "the general sentiment towards the leadership (MOST especially the CEO) of the company (0 = THE LEADERSHIP IS VERY HATED, 1 = THE LEADERSHIP IS VERY LOVED). If the CEO or other high management has been involved in many scandals this score should be low.",
+    'sector': "the general sentiment towards the industry sector of the company, analysed independently from the company itself (0 = THE SECTOR IS VERY HATED, 1 = THE SECTOR IS VERY LOVED). If the sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.",
+    'esg': "how enviornmentally and morally responsible the company is, and how good it is with ESG (0 = THE COMPANY IS VERY IRRESPONSIBLE/IMMORAL, 1 = THE COMPANY IS VERY RESPONSIBLE). If a company's operation sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.",
+}
+
+def qualitative_schema(kinds : list, batch : bool = False):
+    """Returns the JSON schema of a structured qualitative analysis reply. Batch
+       replies are a list of such objects, each with the ticker it is about."""
+    properties = {kind: {"type": "number"} for kind in kinds}
+    required = list(kinds)
+
+    if batch:
+        properties = {"ticker": {"type": "string"}, **properties}
+        required = ["ticker"] + required
+        return {"type": "array", "items": {"type": "object", "properties": properties, "required": required}}
+
+    return {"type": "object", "properties": properties, "required": required}
+
+def qualitative_prompt(tickers : list, kinds : list):
+    """Builds the prompt asking for every score in kinds, for every ticker in tickers."""
+    questions = "\n".join(f"- {kind}: {qualit_questions[kind]}" for kind in kinds)
+    return (f"For each of the companies whose tickers are {', '.join(tickers)}, give the following scores, "
+            f"each as a number between 0 and 1:\n{questions}\n"
+            "The scores should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE.")
+
+def validate_scores(reply : dict, kinds : list):
+    """Checks a structured reply holds a score between 0 and 1 for every kind, and
+       returns them as {kind: score}. Raises a ValueError if it doesn't."""
+    if not isinstance(reply, dict):
+        raise ValueError(f"EXPECTED AN OBJECT OF SCORES, GOT {reply!r}")
+
+    scores = {}
+    for kind in kinds:
+        score = reply.get(kind)
+        if isinstance(score, bool) or not isinstance(score, (int, float)) or not 0 <= score <= 1:
+            raise ValueError(f"INVALID {kind} SCORE IN GEMENI REPLY: {score!r}")
+        scores[kind] = float(score)
+
+    return scores
+
+def reply_entries(reply, key : str, entities : list):
+    """Returns the entries of a batch reply (a list of objects) that are about one of
+       entities, as {entity: entry}, skipping malformed ones."""
+    return {entry[key]: entry for entry in (reply if isinstance(reply, list) else [])
+            if isinstance(entry, dict) and entry.get(key) in entities}
+
+def valid_scores(entries : dict, kinds : list):
+    """Validates the scores of the entries of a batch reply, as {entity: {kind: score}},
+       leaving out the entities with invalid scores."""
+    results = {}
+    for entity, entry in entries.items():
+        try:
+            results[entity] = validate_scores(entry, kinds)
+        except ValueError:
+            pass
+    return results
+
+def batch_prompt_schema(tickers : list, kinds : list):
+    return qualitative_prompt(tickers, kinds), qualitative_schema(kinds, batch=True)
+
+def sectors_prompt_schema(tickers : list):
+    schema = {"type": "array", "items": {"type": "object", "required": ["ticker", "sector"], "properties": {
+        "ticker": {"type": "string"}, "sector": {"type": "string", "enum": gics_sectors}}}}
+    return f"Give the GICS sector of each of the companies whose tickers are {', '.join(tickers)}.", schema
+
+def sector_sentiments_schema():
+    return {"type": "array", "items": {"type": "object", "required": ["sector", "score"], "properties": {
+        "sector": {"type": "string"}, "score": {"type": "number"}}}}
+
+def valid_sectors(reply, tickers : list):
+    """Returns the sectors of a sector classification reply, as {ticker: sector}."""
+    return {ticker: entry["sector"] for ticker, entry in reply_entries(reply, "ticker", tickers).items()
+            if entry.get("sector") in gics_sectors}
+
+def sector_sentiment_prompt(sectors : list):
+    """Builds the prompt asking for the public sentiment score of every sector in sectors."""
+    return (f"Analyse the general sentiment towards each of the following industry sectors: {', '.join(sectors)}. "
+            "Give each a score between 0 (= THE SECTOR IS VERY HATED) and 1 (= THE SECTOR IS VERY LOVED). "
+            "The scores should follow a normal distribution curve. BE BRUTALLY HONEST AND OBJECTIVE. "
+            "If the sector is an enviornmentally-damaging one (like oil or natural gas), it should get a lower score.")
+
+class QualitativeExecutor:
+    """Runs the qualitative analysis with asynchronous Gemeni requests: at most
+       concurrency of them at once, requests_per_minute at most (or within the limits
+       of a shared limiter, see fetch.TokenBucket), each abandoned after timeout seconds."""
+
+    def __init__(self, concurrency : int = 8, requests_per_minute : float = 15, timeout : float = 60, limiter = None):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.limiter = TokenBucket(requests_per_minute) if limiter is None else limiter
+        self.timeout = timeout
+
+    @instrumented('gemeni_request', ticker_arg=None)
+    async def generate_json(self, prompt : str, schema : dict):
+        """Sends a prompt whose reply has to follow a JSON schema, and returns the parsed
+           reply. Raises a TimeoutError if the reply doesn't come within the deadline."""
+        async with self.semaphore:
+            # The limiter blocks, so it is waited for in a thread
+            await asyncio.to_thread(self.limiter.acquire)
+
+            try:
+                response = await asyncio.wait_for(gemeni_model().generate_content_async(prompt, generation_config={
+                    "response_mime_type": "application/json", "response_schema": schema}), self.timeout)
+            except asyncio.TimeoutError:
+                metrics.count('gemeni_timeouts')
+                raise TimeoutError(f"GEMENI REQUEST TIMED OUT AFTER {self.timeout} SECONDS")
+
+        return json.loads(response.text)
+
+    async def analyse_qualitative(self, ticker : str, kinds : list = tuple(qualit_questions)):
+        """Asks for every qualitative score of a ticker in a single structured request.
+           Returns them as {kind: score}, and raises a ValueError if the reply is invalid."""
+        reply = await self.generate_json(qualitative_prompt([ticker], kinds), qualitative_schema(kinds))
+        return validate_scores(reply, kinds)
+
+    async def analyse_qualitative_batch(self, tickers : list, kinds : list = tuple(qualit_questions)):
+        """Asks for every qualitative score of several tickers in a single structured
+           request, the tickers missing from the reply or with invalid scores being
+           analysed again one by one, concurrently. Returns the scores as {ticker: {kind: score}}
+           and the tickers that could not be analysed as {ticker: exception}."""
+        # Any failure of the batch request (malformed reply, deadline, API error such as
+        # a quota one) falls back to one request per ticker, whose failures are reported
+        try:
+            reply = await self.generate_json(*batch_prompt_schema(tickers, kinds))
+        except Exception:
+            reply = []
+
+        results = valid_scores(reply_entries(reply, "ticker", tickers), kinds)
+        missing = [ticker for ticker in tickers if ticker not in results]
+        errors = {}
+
+        retried = await asyncio.gather(*(self.analyse_qualitative(ticker, kinds) for ticker in missing), return_exceptions=True)
+        for ticker, scores in zip(missing, retried):
+            if isinstance(scores, Exception):
+                errors[ticker] = scores
+            else:
+                results[ticker] = scores
+
+        return results, errors
+
+    async def classify_sectors(self, tickers : list):
+        """Maps every ticker in tickers to its GICS sector (see tickers.gics_sectors) in a
+           single structured request. Returns {ticker: sector}, leaving out the tickers the
+           reply has no valid sector for."""
+        try:
+            return valid_sectors(await self.generate_json(*sectors_prompt_schema(tickers)), tickers)
+        except Exception:
+            return {}
+
+    async def analyse_sector_sentiments(self, sectors : list):
+        """Asks for the public sentiment score of several industry sectors in a single
+           structured request, the sectors missing from the reply being asked for again
+           one by one. Returns {sector: score}, leaving out the sectors that could not be
+           scored."""
+        try:
+            reply = await self.generate_json(sector_sentiment_prompt(sectors), sector_sentiments_schema())
+        except Exception:
+            reply = []
+
+        results = {sector: scores["score"] for sector, scores in valid_scores(reply_entries(reply, "sector", sectors), ["score"]).items()}
+        missing = [sector for sector in sectors if sector not in results]
+
+        async def analyse_sector(sector):
+            reply = await self.generate_json(sector_sentiment_prompt([sector]), qualitative_schema(["score"]))
+            return validate_scores(reply, ["score"])["score"]
+
+        retried = await asyncio.gather(*(analyse_sector(sector) for sector in missing), return_exceptions=True)
+        results.update({sector: score for sector, score in zip(missing, retried) if not isinstance(score, Exception)})
+
+        return results
+
+    async def qualitative_scores(self, tickers : list, batch_size : int = 10):
+        """Returns the company, leadership, sector and ESG scores of every ticker, only
+           asking Gemeni for the ones missing from qualit_cache, every batch being analysed
+           concurrently. Sector sentiment is analysed per sector instead of per company.
+           Returns the scores as {ticker: {kind: score}} and the tickers that could not
+           be analysed as {ticker: exception}."""
+        company_kinds = ['company', 'leadership', 'esg']
+        batches = lambda items: [items[start:start + batch_size] for start in range(0, len(items), batch_size)]
+
+        # Sector of each ticker
+        sectors = {ticker: qualit_cache.get('sector_of', ticker) for ticker in tickers}
+        unclassified = [ticker for ticker in tickers if sectors[ticker] is None]
+
+        for classified in await asyncio.gather(*(self.classify_sectors(batch) for batch in batches(unclassified))):
+            qualit_cache.store_many('sector_of', classified)
+            sectors.update(classified)
+
+        scores = {}
+        for ticker in tickers:
+            cached = {kind: qualit_cache.get(kind, ticker) for kind in company_kinds}
+            if None not in cached.values():
+                scores[ticker] = cached
+
+        missing = [ticker for ticker in tickers if ticker not in scores]
+        sector_scores = {sector: qualit_cache.get('sector', sector) for sector in set(sectors.values()) if sector is not None}
+        unscored = [sector for sector, score in sector_scores.items() if score is None]
+
+        # Company-level scores and sector-level scores are asked for at the same time
+        async def no_sectors():
+            return {}
+
+        *batch_results, new_sector_scores = await asyncio.gather(
+            *(self.analyse_qualitative_batch(batch, company_kinds) for batch in batches(missing)),
+            self.analyse_sector_sentiments(unscored) if unscored else no_sectors())
+
+        errors = {}
+        for batch_scores, batch_errors in batch_results:
+            for kind in company_kinds:
+                qualit_cache.store_many(kind, {ticker: batch_scores[ticker][kind] for ticker in batch_scores})
+            scores.update(batch_scores)
+            errors.update(batch_errors)
+
+        qualit_cache.store_many('sector', new_sector_scores)
+        sector_scores.update(new_sector_scores)
+
+        # Tickers whose sector is unknown or could not be scored are asked about directly
+        direct = [ticker for ticker in scores if sector_scores.get(sectors[ticker]) is None]
+        direct_scores = await asyncio.gather(*(self.analyse_qualitative(ticker, ['sector']) for ticker in direct),
+                                             return_exceptions=True)
+
+        for ticker, sector_score in zip(direct, direct_scores):
+            if isinstance(sector_score, Exception):
+                errors[ticker] = sector_score
+                del scores[ticker]
+            else:
+                scores[ticker]['sector'] = sector_score['sector']
+
+        for ticker in scores:
+            if 'sector' not in scores[ticker]:
+                scores[ticker]['sector'] = sector_scores[sectors[ticker]]
+
+        return scores, errors
+
+@instrumented()
+def qualitative_scores(tickers : list, batch_size : int = 10, limiter = None, concurrency : int = 8, timeout : float = 60):
+    """Runs QualitativeExecutor.qualitative_scores from synchronous code (e.g. a worker
+       thread), with a shared rate limiter if one is passed. Returns the scores as
+       {ticker: {kind: score}} and the tickers that could not be analysed as
+       {ticker: exception}."""
+    # The executor's semaphore belongs to the event loop, so each call gets its own
+    executor = QualitativeExecutor(concurrency, timeout=timeout, limiter=limiter)
+    return asyncio.run(executor.qualitative_scores(tickers, batch_size))
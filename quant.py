@@ -2,204 +2,448 @@
 # choices. This code uses the AlphaVantage API, which is free. To use it, go to the
 # AlphaVantage website (https://www.alphavantage.co) and claim an API key. Once done,
 # create a file named 'apikeys.py' and store your API key as a string in a variable
-# called 'alphavantage_api_key'. The file is in the .gitignore
+# called 'alphavantage_api_key'. The file is in the .gitignore. The key is passed to
+# the functions of this file, so importing it doesn't need the key.
 
+import os
 import json
-import requests
-from apikeys import alphavantage_api_key
+import random
+import hashlib
+import threading
+import numpy as np
+from time import time, sleep
+from datetime import datetime, timedelta, timezone
+from cache import StatementCache, atomic_write_json
+from statements import FinancialStatements
+from metrics import metrics, instrumented
+
+# Every AlphaVantage call goes through this single session, so connections to the
+# API are pooled and reused instead of a new one being opened for each request.
+# The pool is sized for the concurrent fetch engine in fetch.py. The session (and the
+# requests library) is only set up on the first request, so the ratio functions can
+# be imported on their own quickly.
+session = None
+session_lock = threading.Lock()
+
+def http_session():
+    """Returns the pooled session AlphaVantage calls go through, creating it first if needed."""
+    global session
+    with session_lock:
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=32))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=32))
+
+    return session
+
+# Endpoint of the API. Only changed to point HedgeHog to a local stand-in (see benchmark.py)
+alphavantage_url = "https://www.alphavantage.co/query"
+
+# Responses are kept on disk and reused until a newer report is expected. Set
+# statement_cache.offline to True to run from the cache only, without any API call.
+statement_cache = StatementCache()
 
 def print_json(data : dict):
     """Prints JSON data in a more presentable way. Mainly used for Debugging."""
     print(json.dumps(data, indent=4))
 
-def alphavantage_api_request(ticker : str, function : str, av_api_key : str):
-    """Auxiliary function that allows for easier AlphaVantage API calls"""
-    req_rep =  requests.get(f"https://www.alphavantage.co/query?function={function}&symbol={ticker}&apikey={av_api_key}")
-    check_api_limit_reached(req_rep)
-    return req_rep
+# Retries of requests refused for a transient reason (per-minute limit, server error,
+# network error), waiting a random time of up to backoff_base * 2^attempt seconds
+# (capped at backoff_cap) before each
+retry_attempts = 4
+backoff_base = 2.0
+backoff_cap = 60.0
+
+# Seconds an AlphaVantage request may take before it is retried
+request_timeout = 30
+
+def classify_response(status_code : int, data):
+    """Tells what an AlphaVantage reply is. Returns one of 'ok', 'minute_limit' (too
+       many requests per minute or second, worth retrying), 'daily_limit' (the day's
+       quota is spent), 'invalid_key', 'invalid_symbol', 'empty' (no reports), 'server_error'
+       (worth retrying) and 'error'."""
+    if status_code == 429:
+        return 'minute_limit'
+    if status_code >= 500 or data is None:
+        return 'server_error'
+    if status_code >= 400 or not isinstance(data, dict):
+        return 'error'
+
+    message = ' '.join(str(data[key]) for key in ('Note', 'Information', 'Error Message') if key in data).lower()
+
+    if message and not set(data) - {'Note', 'Information', 'Error Message'}:
+        if 'per minute' in message or 'per second' in message or 'frequency' in message or 'sparingly' in message:
+            return 'minute_limit'
+        if 'per day' in message or 'daily' in message:
+            return 'daily_limit'
+        if 'apikey' in message or 'api key' in message:
+            return 'invalid_key'
+        if 'invalid api call' in message:
+            return 'invalid_symbol'
+        return 'error'
+
+    if not any(data.get(key) for key in ('annualReports', 'quarterlyReports', 'annualEarnings', 'quarterlyEarnings')):
+        return 'empty'
+
+    return 'ok'
+
+def key_id(api_key : str):
+    """Identifies an API key in files without storing the key itself."""
+    return hashlib.sha256(str(api_key).encode()).hexdigest()[:16]
+
+class CircuitBreaker:
+    """Stops every AlphaVantage request with an API key once it can't be used for the
+       rest of the day (daily quota spent, or invalid key), instead of spending time on
+       requests that are sure to fail. Each key has its own state, so changing the key
+       in apikeys.py resumes the requests right away. Spent quotas are kept on disk, so
+       that later runs of the same day don't try again either; invalid keys are only
+       remembered by the current process, since the key may be fixed before the next run."""
+
+    def __init__(self, path : str = os.path.join('cache', 'circuit_breaker.json')):
+        self.path = path
+        self.lock = threading.Lock()
+
+        # {key id: {'open_until': timestamp, 'reason': kind}}, saved ones and process-only ones
+        self.saved = {}
+        self.process_only = {}
+
+        try:
+            with open(path) as breaker_file:
+                state = json.load(breaker_file)
+            self.saved = {key: entry for key, entry in state.items() if isinstance(entry, dict) and 'open_until' in entry}
+        except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+            pass
+
+    def check(self, api_key : str):
+        """Raises a ConnectionRefusedError while the breaker of an API key is open."""
+        key = key_id(api_key)
+        for states in (self.process_only, self.saved):
+            entry = states.get(key)
+            if entry is not None and time() < entry['open_until']:
+                raise ConnectionRefusedError(f"ALPHA VANTAGE REQUESTS STOPPED UNTIL {datetime.fromtimestamp(entry['open_until']):%Y-%m-%d %H:%M} ({entry['reason']}). TRY AGAIN LATER, SUBSCRIBE TO PREMIUM OR CHANGE THE API KEY IN apikeys.py")
+
+    def trip(self, api_key : str, reason : str, persist : bool = True):
+        """Opens the breaker of an API key until the quota resets, at the next UTC
+           midnight. Unless persist is False, the state is saved for later runs."""
+        tomorrow = datetime.now(timezone.utc).date() + timedelta(days=1)
+        entry = {'open_until': datetime(tomorrow.year, tomorrow.month, tomorrow.day, tzinfo=timezone.utc).timestamp(),
+                 'reason': reason}
+
+        with self.lock:
+            if not persist:
+                self.process_only[key_id(api_key)] = entry
+            else:
+                # Expired states are dropped on the way
+                self.saved = {key: saved for key, saved in self.saved.items() if saved['open_until'] > time()}
+                self.saved[key_id(api_key)] = entry
+                atomic_write_json(self.path, self.saved)
+
+        metrics.count('circuit_breaker_trips')
+
+circuit_breaker = CircuitBreaker()
+
+class RequestLedger:
+    """Counts the requests sent with every API key over the current UTC day (the
+       period of AlphaVantage's quota), retries included, and keeps the counts on disk
+       so that every run of the day draws from the same daily budget. When limit is
+       set, requests beyond it are refused."""
+
+    def __init__(self, path : str = os.path.join('cache', 'request_ledger.json')):
+        self.path = path
+        self.limit = None
+        self.lock = threading.Lock()
+
+        try:
+            with open(path) as ledger_file:
+                self.days = json.load(ledger_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self.days = {}
+
+    def spent(self, api_key : str):
+        """Returns the number of requests sent with an API key today."""
+        entry = self.days.get(key_id(api_key))
+        return entry['requests'] if entry and entry['day'] == str(datetime.now(timezone.utc).date()) else 0
+
+    def charge(self, api_key : str):
+        """Counts a request about to be sent. Raises a ConnectionRefusedError instead if
+           the daily budget (limit) is spent."""
+        with self.lock:
+            spent = self.spent(api_key)
+            if self.limit is not None and spent >= self.limit:
+                raise ConnectionRefusedError(f"DAILY ALPHA VANTAGE REQUEST BUDGET OF {self.limit} SPENT. TRY AGAIN TOMORROW OR RAISE THE BUDGET")
+
+            self.days[key_id(api_key)] = {'day': str(datetime.now(timezone.utc).date()), 'requests': spent + 1}
+            atomic_write_json(self.path, self.days)
+
+request_ledger = RequestLedger()
+
+def backoff_delay(attempt : int):
+    """Returns the time to wait before a retry, with full jitter, so that the threads
+       of the fetch engine don't all retry at once."""
+    return random.uniform(0, min(backoff_cap, backoff_base * 2**attempt))
+
+@instrumented('alphavantage_request')
+def alphavantage_api_request(ticker : str, function : str, av_api_key : str, limiter = None, refresh : bool = None):
+    """Auxiliary function that allows for easier AlphaVantage API calls. Returns the
+       parsed JSON response, from the statement cache if it holds a fresh copy. With
+       refresh=True the cache is bypassed, and with refresh=False the cached copy is
+       returned however old it is (a LookupError is raised if there is none). If a
+       rate limiter (see fetch.TokenBucket) is passed, a token is taken from it before
+       a request is actually sent.
+       Throttled and failed requests are retried with exponential backoff. Once the
+       daily quota is spent, a ConnectionRefusedError is raised and no more requests
+       are sent that day (see CircuitBreaker), and so once the daily request budget
+       of request_ledger is spent. Invalid symbols and replies without
+       reports raise a ValueError, and requests still failing after the retries a
+       ConnectionError."""
+    if refresh is not True or statement_cache.offline:
+        cached = statement_cache.get(ticker, function, stale_ok=refresh is False)
+        if cached is not None:
+            metrics.count('statement_cache_hits', ticker)
+            return cached
+
+    for attempt in range(retry_attempts + 1):
+        circuit_breaker.check(av_api_key)
+
+        if limiter is not None:
+            limiter.acquire()
+
+        request_ledger.charge(av_api_key)
+        metrics.count('alphavantage_requests', ticker)
+        try:
+            with metrics.timed('alphavantage_latency', ticker):
+                req_rep = http_session().get(f"{alphavantage_url}?function={function}&symbol={ticker}&apikey={av_api_key}",
+                                             timeout=request_timeout)
+            try:
+                parsed_json = req_rep.json()
+            except ValueError:
+                parsed_json = None
+            kind = classify_response(req_rep.status_code, parsed_json)
+        except OSError:
+            # Network errors and timeouts (the exceptions of requests are OSErrors)
+            kind = 'server_error'
+
+        if kind == 'ok':
+            statement_cache.store(ticker, function, parsed_json)
+            return parsed_json
+
+        metrics.count(f'alphavantage_{kind}', ticker)
+
+        if kind in ('daily_limit', 'invalid_key'):
+            circuit_breaker.trip(av_api_key, kind, persist=kind == 'daily_limit')
+            circuit_breaker.check(av_api_key)
+        if kind == 'invalid_symbol':
+            raise ValueError(f'{ticker} IS NOT A SYMBOL ALPHA VANTAGE KNOWS ({function})')
+        if kind == 'empty':
+            raise ValueError(f'ALPHA VANTAGE HAS NO {function} REPORTS FOR {ticker}')
+        if kind == 'error':
+            raise ValueError(f'ALPHA VANTAGE REFUSED THE {function} REQUEST OF {ticker}: {parsed_json}')
+
+        if attempt < retry_attempts:
+            sleep(backoff_delay(attempt))
+
+    raise ConnectionError(f'ALPHA VANTAGE {function} REQUEST OF {ticker} STILL FAILING AFTER {retry_attempts} RETRIES ({kind})')
 
 def check_api_limit_reached(param : dict) :
     """Checks if the AlphaVantage API call limit is reached when the API is called"""
-    if param == {'Information': 'Thank you for using Alpha Vantage! Our standard API rate limit is 25 requests per day. Please subscribe to any of the premium plans at https://www.alphavantage.co/premium/ to instantly remove all daily rate limits.'} :
+    if classify_response(200, param) == 'daily_limit':
         raise ConnectionRefusedError("ALPHA VANTAGE API REQUEST LIMIT REACHED. TRY AGAIN LATER, SUBSCRIBE TO PREMIUM OR CHANGE THE API KEY IN apikeys.py")
     
 
+@instrumented()
 def get_income_statement(ticker : str, av_api_key : str):
     """Retrieves the financial statement of a ticker. ticker has to be of type 
        string. Function requires an AlphaVantage API key as an argument."""
     
-    api_req_response = alphavantage_api_request(ticker, 'INCOME_STATEMENT', av_api_key)
-    check_api_limit_reached(api_req_response)
-    parsed_json = api_req_response.json()
-    return parsed_json
+    return alphavantage_api_request(ticker, 'INCOME_STATEMENT', av_api_key)
 
+@instrumented()
 def get_balance_sheet(ticker : str, av_api_key : str):
     """Retrieves the balance sheet of a ticker. ticker has to be of type string.
        Function requires an AlphaVantage API key as an argument"""
     
-    api_req_response = alphavantage_api_request(ticker, 'BALANCE_SHEET', av_api_key)
-    check_api_limit_reached(api_req_response)
-    parsed_json = api_req_response.json()
-    return parsed_json
+    return alphavantage_api_request(ticker, 'BALANCE_SHEET', av_api_key)
 
+@instrumented()
 def get_cash_flow(ticker : str, av_api_key : str):
     """Retrieves the cash flow of a ticker. ticker has to be of type string.
     Function requires an AlphaVantage API key as an argument"""
     
-    api_req_response = alphavantage_api_request(ticker, 'CASH_FLOW', av_api_key)
-    check_api_limit_reached(api_req_response)
-    parsed_json = api_req_response.json()
-    return parsed_json
+    return alphavantage_api_request(ticker, 'CASH_FLOW', av_api_key)
 
 
+@instrumented()
 def get_earnings(ticker : str, av_api_key : str):
     """Retrieves the cash earnings of a ticker. ticker has to be of type string.
     Function requires an AlphaVantage API key as an argument"""
     
-    api_req_response = alphavantage_api_request(ticker, 'EARNINGS', av_api_key)
-    check_api_limit_reached(api_req_response)
-    parsed_json = api_req_response.json()
-    return parsed_json
-
-def liabilities_to_equity(balance_sheet : dict):
-    """Calculates the Libailities-to-Equity ratio of a company whose balance sheet is 
-       passed as a dictionary-type argument. Returns False if it fails to calculate"""
-    
-    check_api_limit_reached(balance_sheet)
-    
-    if balance_sheet["annualReports"][1]["totalLiabilities"] == "None" or balance_sheet["annualReports"][1]["totalShareholderEquity"] == "None" or balance_sheet["annualReports"][1]["totalShareholderEquity"] == "0":
+    return alphavantage_api_request(ticker, 'EARNINGS', av_api_key)
+
+# The ratios are first calculated on whole columns by the *_columns functions below,
+# which work on any object holding the statement fields as arrays whose last axis is
+# the fiscal year (most recent first): a FinancialStatements, or a (tickers x years)
+# panel of the whole universe like the one built in backtest.py. The per-company
+# functions then pick the year they need out of the result.
+
+def divide(numerator : np.ndarray, denominator : np.ndarray):
+    """Elementwise division of statement columns. The result is NaN wherever a value
+       is missing or the denominator is 0."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(denominator == 0, np.nan, numerator / denominator)
+
+def growth_columns(column : np.ndarray, years : int = 9):
+    """Growth (in %) of a column over years fiscal years. Index i of the result is the
+       growth from fiscal year i + years to fiscal year i."""
+    result = np.full(column.shape, np.nan)
+    result[..., :-years] = divide(column[..., :-years] - column[..., years:], column[..., years:]) * 100
+    return result
+
+def pick_year(columns : np.ndarray, year : int = 1):
+    """Returns the value of a calculated column for a fiscal year (1 being the last
+       complete one, like annualReports[1]), or False if it could not be calculated."""
+    if year >= columns.shape[-1] or np.isnan(columns[year]):
         return False
+    return float(columns[year])
+
+def liabilities_to_equity_columns(statements):
+    """Liabilities-to-Equity ratio of every fiscal year of the statements."""
+    return divide(statements.total_liabilities, statements.total_shareholder_equity)
+
+def liabilities_to_capital_columns(statements):
+    """Liabilities-to-Capital ratio of every fiscal year of the statements."""
+    return divide(statements.total_liabilities, statements.total_liabilities + statements.total_shareholder_equity)
+
+def assets_to_equity_columns(statements):
+    """Total Assets-to-Equity ratio of every fiscal year of the statements."""
+    return divide(statements.total_assets, statements.total_shareholder_equity)
+
+def debt_to_ebitda_columns(statements):
+    """Total Debt-to-EBITDA ratio of every fiscal year of the statements."""
+    return divide(statements.total_liabilities, statements.ebitda)
+
+def quick_ratio_columns(statements):
+    """Quick ratio of every fiscal year of the statements."""
+    cash_plus_ce = statements.cash_and_equivalents
+    ms = statements.total_current_assets
+    nar = statements.current_net_receivables
+    return divide(cash_plus_ce + ms + nar, statements.total_current_liabilities)
+
+def current_ratio_columns(statements):
+    """Current ratio of every fiscal year of the statements."""
+    return divide(statements.total_current_assets, statements.total_current_liabilities)
+
+def ten_yr_operating_expenses_growth_columns(statements):
+    """10yr op. expenses growth of every fiscal year of the statements."""
+    return growth_columns(statements.operating_expenses)
+
+def ten_yr_assets_growth_columns(statements):
+    """10yr assets growth of every fiscal year of the statements."""
+    return growth_columns(statements.total_assets)
+
+def ten_yr_liabilities_growth_columns(statements):
+    """10yr liabilities growth of every fiscal year of the statements."""
+    return growth_columns(statements.total_liabilities)
+
+def ten_yr_cash_flow_growth_columns(statements):
+    """10yr cash flow growth of every fiscal year of the statements."""
+    return growth_columns(statements.operating_cashflow)
+
+def ten_yr_share_count_growth_columns(statements):
+    """10yr share count growth of every fiscal year of the statements."""
+    return growth_columns(statements.common_stock)
+
+# Column functions of every ratio, by their scorecalc metric name
+ratio_columns = {
+    'liabilities_to_equity': liabilities_to_equity_columns,
+    'liabilities_to_capital': liabilities_to_capital_columns,
+    'assets_to_equity': assets_to_equity_columns,
+    'debt_to_ebitda': debt_to_ebitda_columns,
+    'quick_ratio': quick_ratio_columns,
+    'current_ratio': current_ratio_columns,
+    'ten_yr_opex_growth': ten_yr_operating_expenses_growth_columns,
+    'ten_yr_assets_growth': ten_yr_assets_growth_columns,
+    'ten_yr_liabilities_growth': ten_yr_liabilities_growth_columns,
+    'ten_yr_cash_flow_growth': ten_yr_cash_flow_growth_columns,
+    'ten_yr_share_count_growth': ten_yr_share_count_growth_columns,
+}
+
+@instrumented()
+def liabilities_to_equity(statements : FinancialStatements, year : int = 1):
+    """Calculates the Libailities-to-Equity ratio of a company whose statements are 
+       passed as a FinancialStatements argument. Returns False if it fails to calculate"""
     
-    return (int(balance_sheet["annualReports"][1]["totalLiabilities"]) / int(balance_sheet["annualReports"][1]["totalShareholderEquity"]))
+    return pick_year(liabilities_to_equity_columns(statements), year)
 
-def liabilities_to_capital(balance_sheet : dict):
-    """Calculates the Liabilities-to-Capital ratio of a company whose balance sheet is 
-       passed as a dictionary-type argument. Returns False if it fails to calculate"""
-    
-    check_api_limit_reached(balance_sheet)
+@instrumented()
+def liabilities_to_capital(statements : FinancialStatements, year : int = 1):
+    """Calculates the Liabilities-to-Capital ratio of a company whose statements are 
+       passed as a FinancialStatements argument. Returns False if it fails to calculate"""
     
-    if balance_sheet["annualReports"][1]["totalLiabilities"] == "None" or balance_sheet["annualReports"][1]["totalShareholderEquity"] == "None" or int(balance_sheet["annualReports"][1]["totalLiabilities"]) + int(balance_sheet["annualReports"][1]["totalShareholderEquity"]) == "0":
-        return False
-    
-    return (int(balance_sheet["annualReports"][1]["totalLiabilities"]) / (int(balance_sheet["annualReports"][1]["totalLiabilities"]) + int(balance_sheet["annualReports"][1]["totalShareholderEquity"])))
+    return pick_year(liabilities_to_capital_columns(statements), year)
 
-def assets_to_equity(balance_sheet : dict):
-    """Calculates the Total Assets-to-Equity ratio of a company whose balance sheet is 
-       passed as a dictionary-type argument. Returns False if it fails to calculate"""
-    
-    check_api_limit_reached(balance_sheet)
+@instrumented()
+def assets_to_equity(statements : FinancialStatements, year : int = 1):
+    """Calculates the Total Assets-to-Equity ratio of a company whose statements are 
+       passed as a FinancialStatements argument. Returns False if it fails to calculate"""
     
-    if balance_sheet["annualReports"][1]["totalAssets"] == "None" or balance_sheet["annualReports"][1]["totalShareholderEquity"] == "None" or balance_sheet["annualReports"][1]["totalShareholderEquity"] == "0":
-        return False
-    
-    return (int(balance_sheet["annualReports"][1]["totalAssets"]) / int(balance_sheet["annualReports"][1]["totalShareholderEquity"]))
+    return pick_year(assets_to_equity_columns(statements), year)
 
-def debt_to_ebitda(balance_sheet : dict, income_statement : dict):
-    """Calculates the Total Debt-to-EBITDA ratio of a company whose balance sheet is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
+@instrumented()
+def debt_to_ebitda(statements : FinancialStatements, year : int = 1):
+    """Calculates the Total Debt-to-EBITDA ratio of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-    check_api_limit_reached(balance_sheet)
-    check_api_limit_reached(income_statement)
+    return pick_year(debt_to_ebitda_columns(statements), year)
 
-    if balance_sheet["annualReports"][1]["totalLiabilities"] == "None" or income_statement["annualReports"][1]["ebitda"] == "None" or income_statement["annualReports"][1]["ebitda"] == "0":
-            return False
-    
-    return (int(balance_sheet["annualReports"][1]["totalLiabilities"]) / int(income_statement["annualReports"][1]["ebitda"]))
+@instrumented()
+def quick_ratio(statements : FinancialStatements, year : int = 1):
+    """Calculates the quick ratio of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-def quick_ratio(balance_sheet : dict):
-    """Calculates the quick ratio of a company whose balance sheet is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
+    return pick_year(quick_ratio_columns(statements), year)
 
-    check_api_limit_reached(balance_sheet)
+@instrumented()
+def current_ratio(statements : FinancialStatements, year : int = 1):
+    """Calculates the current ratio of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-    cash_plus_ce = balance_sheet["annualReports"][1]["cashAndCashEquivalentsAtCarryingValue"]
-    ms = balance_sheet["annualReports"][1]["totalCurrentAssets"]
-    nar = balance_sheet["annualReports"][1]["currentNetReceivables"]
-    current_liabilities = balance_sheet["annualReports"][1]["totalCurrentLiabilities"]
-    
-    if cash_plus_ce == "None" or ms == "None" or nar == "None" or current_liabilities == "None" or current_liabilities == "0":
-        return False
-    
-    return ((int(cash_plus_ce) + int(ms) + int(nar))/(int(current_liabilities)))
+    return pick_year(current_ratio_columns(statements), year)
 
+@instrumented()
+def ten_yr_operating_expenses_growth(statements : FinancialStatements, year : int = 1):
+    """Calculates the 10yr op. expenses growth of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-def current_ratio(balance_sheet : dict):
-    """Calculates the current ratio of a company whose balance sheet is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
+    return pick_year(ten_yr_operating_expenses_growth_columns(statements), year)
 
-    check_api_limit_reached(balance_sheet)
-    
-    if balance_sheet["annualReports"][1]["totalCurrentAssets"] == "None" or balance_sheet["annualReports"][1]["totalCurrentLiabilities"] == "None" or balance_sheet["annualReports"][1]["totalCurrentLiabilities"] == "0":
-        return False
-    
-    return (int(balance_sheet["annualReports"][1]["totalCurrentAssets"]) / int(balance_sheet["annualReports"][1]["totalCurrentLiabilities"]))
+@instrumented()
+def ten_yr_assets_growth(statements : FinancialStatements, year : int = 1):
+    """Calculates the 10yr assets growth of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-def ten_yr_operating_expenses_growth(income_statement : dict):
-    """Calculates the 10yr op. expenses growth of a company whose income statement is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
+    return pick_year(ten_yr_assets_growth_columns(statements), year)
 
-    check_api_limit_reached(income_statement)
+@instrumented()
+def ten_yr_liabilities_growth(statements : FinancialStatements, year : int = 1):
+    """Calculates the 10yr liabilities growth of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-    if len(income_statement["annualReports"]) < 11 :
-        return False
+    return pick_year(ten_yr_liabilities_growth_columns(statements), year)
 
-    if income_statement["annualReports"][1]["operatingExpenses"] == "None" or income_statement["annualReports"][10]["operatingExpenses"] == "None" or income_statement["annualReports"][10]["operatingExpenses"] == "0":
-        return False
-    
-    return ((int(income_statement["annualReports"][1]["operatingExpenses"]) - int(income_statement["annualReports"][10]["operatingExpenses"]))/(int(income_statement["annualReports"][10]["operatingExpenses"]))) * 100
+@instrumented()
+def ten_yr_cash_flow_growth(statements : FinancialStatements, year : int = 1):
+    """Calculates the 10yr cash flow growth of a company whose statements (including
+    its cash flow report) are passed as a FinancialStatements argument. Returns False
+    if it fails to calculate"""
 
-def ten_yr_assets_growth(balance_sheet : dict):
-    """Calculates the 10yr assets growth of a company whose balance sheet is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
+    return pick_year(ten_yr_cash_flow_growth_columns(statements), year)
 
-    check_api_limit_reached(balance_sheet)
-    
-    if len(balance_sheet["annualReports"]) < 11 :
-        return False
-    
-    if balance_sheet["annualReports"][1]["totalAssets"] == "None" or balance_sheet["annualReports"][10]["totalAssets"] == "None" or balance_sheet["annualReports"][10]["totalAssets"] == "0" :
-        return False
-    
-    return ((int(balance_sheet["annualReports"][1]["totalAssets"]) - int(balance_sheet["annualReports"][10]["totalAssets"]))/(int(balance_sheet["annualReports"][10]["totalAssets"]))) * 100
-
-def ten_yr_liabilities_growth(balance_sheet : dict):
-    """Calculates the 10yr liabilities growth of a company whose balance sheet is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
-
-    check_api_limit_reached(balance_sheet)
+@instrumented()
+def ten_yr_share_count_growth(statements : FinancialStatements, year : int = 1):
+    """Calculates the 10yr share count growth of a company whose statements are 
+    passed as a FinancialStatements argument. Returns False if it fails to calculate"""
 
-    if len(balance_sheet["annualReports"]) < 11 :
-        return False
-
-    if balance_sheet["annualReports"][1]["totalLiabilities"] == "None" or balance_sheet["annualReports"][10]["totalLiabilities"] == "None" or balance_sheet["annualReports"][10]["totalLiabilities"] == "0":
-        return False
-    
-    return ((int(balance_sheet["annualReports"][1]["totalLiabilities"]) - int(balance_sheet["annualReports"][10]["totalLiabilities"]))/(int(balance_sheet["annualReports"][10]["totalLiabilities"]))) * 100
-
-def ten_yr_cash_flow_growth(cash_flow_report : dict):
-    """Calculates the 10yr liabilities growth of a company whose cash flow report is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
-
-    check_api_limit_reached(cash_flow_report)
-
-    if len(cash_flow_report["annualReports"]) < 11 :
-        return False
-
-    if cash_flow_report["annualReports"][1]["operatingCashflow"] == "None" or cash_flow_report["annualReports"][10]["operatingCashflow"] == "None" or cash_flow_report["annualReports"][10]["operatingCashflow"] == "0":
-        return False
-    
-    return ((int(cash_flow_report["annualReports"][1]["operatingCashflow"]) - int(cash_flow_report["annualReports"][10]["operatingCashflow"]))/(int(cash_flow_report["annualReports"][10]["operatingCashflow"]))) * 100
-
-def ten_yr_share_count_growth(balance_sheet : dict):
-    """Calculates the 10yr share count growth of a company whose balance sheet is 
-    passed as a dictionary-type argument. Returns False if it fails to calculate"""
-
-    check_api_limit_reached(balance_sheet)
-
-    if len(balance_sheet["annualReports"]) < 11 :
-        return False
-
-    if balance_sheet["annualReports"][1]["commonStock"] == "None" or balance_sheet["annualReports"][10]["commonStock"] == "None" or balance_sheet["annualReports"][10]["commonStock"] == "0":
-        return False
-    
-    return ((int(balance_sheet["annualReports"][1]["commonStock"]) - int(balance_sheet["annualReports"][10]["commonStock"]))/(int(balance_sheet["annualReports"][10]["commonStock"]))) * 100
+    return pick_year(ten_yr_share_count_growth_columns(statements), year)
@@ -0,0 +1,222 @@
+# The code in this file keeps a persistent, ranked index of the average score of every
+# company of the universe, so that the portfolio can be re-selected when only a few
+# companies were rescored, without re-sorting the whole universe. The index is a treap
+# (a binary search tree balanced by random priorities) ordered by score, in which every
+# node also keeps the size and score total of its subtree. Updating k companies takes
+# O(k log n), and so does finding the above-median cut and the total of the selected
+# scores the weights are normalized by. The scores are saved to disk between runs.
+# The file also compares a newly selected portfolio with the previous portfolio.txt.
+
+import re
+import json
+import random
+from cache import atomic_write_json
+
+class IndexNode:
+    """Node of the score index, ordered by (score, ticker)."""
+
+    __slots__ = ('key', 'priority', 'left', 'right', 'size', 'total')
+
+    def __init__(self, ticker : str, score : float):
+        self.key = (score, ticker)
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+        self.total = score
+
+    def update(self):
+        """Recalculates the size and score total of the subtree from its children."""
+        self.size = 1 + subtree_size(self.left) + subtree_size(self.right)
+        self.total = self.key[0] + subtree_total(self.left) + subtree_total(self.right)
+
+def subtree_size(node : IndexNode):
+    return 0 if node is None else node.size
+
+def subtree_total(node : IndexNode):
+    return 0.0 if node is None else node.total
+
+def split(node : IndexNode, key : tuple):
+    """Splits a subtree into the nodes whose key is lower than key and the others."""
+    if node is None:
+        return None, None
+
+    if node.key < key:
+        node.right, right = split(node.right, key)
+        node.update()
+        return node, right
+
+    left, node.left = split(node.left, key)
+    node.update()
+    return left, node
+
+def merge(left : IndexNode, right : IndexNode):
+    """Merges two subtrees, every key of left being lower than every key of right."""
+    if left is None or right is None:
+        return left or right
+
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        left.update()
+        return left
+
+    right.left = merge(left, right.left)
+    right.update()
+    return right
+
+def remove(node : IndexNode, key : tuple):
+    """Removes the node with the given key from a subtree and returns the subtree."""
+    if node is None:
+        return None
+
+    if key == node.key:
+        return merge(node.left, node.right)
+
+    if key < node.key:
+        node.left = remove(node.left, key)
+    else:
+        node.right = remove(node.right, key)
+
+    node.update()
+    return node
+
+class ScoreIndex:
+    """Persistent index of the universe's average scores, ranked from lowest to highest."""
+
+    def __init__(self, path : str = 'score_index.json'):
+        self.path = path
+        self.root = None
+        self.scores = {}
+
+        try:
+            with open(path) as index_file:
+                saved = json.load(index_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            saved = {}
+
+        self.update(saved)
+
+    def __len__(self):
+        return subtree_size(self.root)
+
+    def __contains__(self, ticker : str):
+        return ticker in self.scores
+
+    def update(self, scores : dict):
+        """Sets the scores of some companies, as {ticker: score}, a score of None
+           removing the company from the index. Companies whose score did not change
+           are left alone. Returns the number of companies changed."""
+        changed = 0
+
+        for ticker, score in scores.items():
+            previous = self.scores.get(ticker)
+            if score == previous:
+                continue
+
+            if previous is not None:
+                self.root = remove(self.root, (previous, ticker))
+                del self.scores[ticker]
+
+            if score is not None:
+                left, right = split(self.root, (score, ticker))
+                self.root = merge(merge(left, IndexNode(ticker, score)), right)
+                self.scores[ticker] = score
+
+            changed += 1
+
+        return changed
+
+    def lowest_total(self, count : int):
+        """Returns the total of the count lowest scores."""
+        node = self.root
+        total = 0.0
+
+        while node is not None and count > 0:
+            left_size = subtree_size(node.left)
+            if count <= left_size:
+                node = node.left
+            else:
+                total += subtree_total(node.left) + node.key[0]
+                count -= left_size + 1
+                node = node.right
+
+        return total
+
+    def ranked(self, start : int = 0):
+        """Yields (ticker, score) pairs by increasing score, from the start-th lowest."""
+        stack = []
+        node = self.root
+
+        # Goes down to the start-th node, stacking the nodes still to be yielded
+        while node is not None:
+            left_size = subtree_size(node.left)
+            if start < left_size:
+                stack.append(node)
+                node = node.left
+            elif start == left_size:
+                stack.append(node)
+                break
+            else:
+                start -= left_size + 1
+                node = node.right
+
+        while stack:
+            node = stack.pop()
+            yield node.key[1], node.key[0]
+
+            node = node.right
+            while node is not None:
+                stack.append(node)
+                node = node.left
+
+    def select(self):
+        """Selects the companies scored above the median like main.py always has (the
+           top half of the ranking) and returns them as (ticker, weight) pairs by
+           increasing score, each weight being proportional to the company's score."""
+        cut = len(self) // 2
+        selected_total = subtree_total(self.root) - self.lowest_total(cut)
+
+        if selected_total <= 0:
+            return []
+
+        return [(ticker, score / selected_total) for ticker, score in self.ranked(cut)]
+
+    def save(self):
+        """Writes the scores to disk, so that the next run can start from them."""
+        atomic_write_json(self.path, self.scores)
+
+portfolio_line = re.compile(r'Buy ([0-9.]+)\$ of (\S+) shares')
+
+def read_portfolio(path : str = 'portfolio.txt'):
+    """Reads a portfolio file written by main.py. Returns {ticker: amount}, empty if
+       there is no portfolio file yet."""
+    try:
+        with open(path) as portfolio_file:
+            matches = (portfolio_line.match(line) for line in portfolio_file)
+            return {match.group(2): float(match.group(1)) for match in matches if match}
+    except FileNotFoundError:
+        return {}
+
+def portfolio_diff(previous : dict, current : dict):
+    """Compares two portfolios of the form {ticker: amount}. Returns the companies to
+       buy (not held before), to sell (no longer selected) and to adjust (held in both,
+       with the change of amount), each as {ticker: amount}."""
+    return {
+        'buy': {ticker: amount for ticker, amount in current.items() if ticker not in previous},
+        'sell': {ticker: amount for ticker, amount in previous.items() if ticker not in current},
+        'adjust': {ticker: round(amount - previous[ticker], 2) for ticker, amount in current.items()
+                   if ticker in previous and round(amount - previous[ticker], 2) != 0},
+    }
+
+def write_portfolio(path : str, portfolio : dict):
+    """Writes a portfolio of the form {ticker: amount} to a portfolio file."""
+    with open(path, 'w') as portfolio_file:
+        for pick, amount in portfolio.items():
+            portfolio_file.write(f"Buy {amount:.2f}$ of {pick} shares\n")
+
+def describe_diff(diff : dict):
+    """Returns the changes of a portfolio_diff as lines of text."""
+    return ([f'New position: buy {amount:.2f}$ of {pick}' for pick, amount in diff['buy'].items()] +
+            [f'Closed position: sell the {amount:.2f}$ of {pick}' for pick, amount in diff['sell'].items()] +
+            [f'Adjusted position: {"buy" if amount > 0 else "sell"} {abs(amount):.2f}$ of {pick}'
+             for pick, amount in diff['adjust'].items()])
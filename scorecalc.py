@@ -1,68 +1,191 @@
 # The code in this file calculates the 'score' the algorithm attributes to each company
 # based on a normal distribution curve. This data is then used by the 'main.py' file
-# to make the decision on whether to buy the company or not
+# to make the decision on whether to buy the company or not. Besides the per-company
+# functions, score_universe scores a whole universe of ratios in one NumPy pass, so
+# that the universe can be rescored after a parameter change without refetching.
+# The distribution parameters below are the defaults: load_score_params replaces them
+# with the ones of a score_params.json file (written by calibrate.py), along with any
+# per-sector parameters it holds. It is called when a run starts (see pipeline.run),
+# not when this file is imported.
 
-from math import exp, sqrt, pi
+import json
+import numpy as np
+from math import exp
 from quant import *
-from apikeys import *
+
+# (standard deviation, mean) of the normal distribution curve each metric is scored on
+distribution_params = {
+    'liabilities_to_equity': (0.425, 1.0),
+    'liabilities_to_capital': (0.128, 0.45),
+    'assets_to_equity': (0.5, 1.5),
+    'debt_to_ebitda': (0.425, 1),
+    'quick_ratio': (0.213, 1.0),
+    'current_ratio': (0.213, 1.0),
+    'ten_yr_opex_growth': (34, 120),
+    'ten_yr_assets_growth': (64, 125),
+    'ten_yr_liabilities_growth': (47, 95),
+    'ten_yr_cash_flow_growth': (8.5, 10),
+    'ten_yr_share_count_growth': (8.5, 10),
+}
+
+# Parameters of the companies of some sectors, as {sector: {metric: (std, mean)}}.
+# Metrics missing from a sector use distribution_params.
+sector_params = {}
+
+def params_pair(values):
+    """Converts the (std, mean) pair of a parameter file to a tuple of floats. Raises a
+       ValueError if it isn't one."""
+    std, mean = (float(value) for value in values)
+    if not std > 0:
+        raise ValueError(f'STANDARD DEVIATION {std} IS NOT POSITIVE')
+    return std, mean
+
+def load_score_params(path : str = 'score_params.json'):
+    """Replaces the distribution parameters with the ones of a parameter file, if
+       there is one. Returns whether a file was loaded. Raises a ValueError, leaving
+       the parameters as they were, if the file is malformed."""
+    try:
+        with open(path) as params_file:
+            params = json.load(params_file)
+
+        distribution = {metric: params_pair(values) for metric, values in params['distribution_params'].items()}
+        sectors = {sector: {metric: params_pair(values) for metric, values in metrics.items()}
+                   for sector, metrics in params.get('sector_params', {}).items()}
+    except FileNotFoundError:
+        return False
+    except (ValueError, KeyError, TypeError, AttributeError) as error:
+        raise ValueError(f'MALFORMED PARAMETER FILE "{path}" ({error!r}). FIX IT, OR DELETE IT TO USE THE DEFAULT PARAMETERS') from None
+
+    unknown = distribution.keys() - distribution_params.keys()
+    if unknown:
+        raise ValueError(f'UNKNOWN METRICS IN PARAMETER FILE "{path}": {", ".join(sorted(unknown))}')
+
+    distribution_params.update(distribution)
+    sector_params.clear()
+    sector_params.update(sectors)
+    return True
 
 def standardized_normal_dist(x : float, std : float, mean : float):
     """Returns the normal place of x in a normal distribution curve whose standard
-       variation and expected value are passed as parameters."""
-    peak_val = (1/sqrt(2 * pi * (std**2))) * exp(-((mean - mean)**2/(2 * std**2)))
-    return ((1/sqrt(2 * pi * (std**2))) * exp(-((x - mean)**2/(2 * std**2))))/peak_val
+       variation and expected value are passed as parameters. The curve is scaled so
+       its peak (at x = mean) is 1, which cancels out its normalisation constant."""
+    return exp(-((x - mean)**2/(2 * std**2)))
+
+@instrumented(ticker_arg=None)
+def ratio_score(metric : str, val : float):
+    """Returns the score attributed to an already calculated ratio, metric being its
+       key in distribution_params."""
+    return standardized_normal_dist(val, *distribution_params[metric])
 
-def liabilities_to_equity_score(balance_sheet : dict):
+@instrumented()
+def liabilities_to_equity_score(statements : FinancialStatements):
     """Returns the score attributed to a company's liabilities to equity ratio."""
-    val = liabilities_to_equity(balance_sheet)
-    return standardized_normal_dist(val, 0.425, 1.0)
+    val = liabilities_to_equity(statements)
+    return ratio_score('liabilities_to_equity', val)
 
-def liabilities_to_capital_score(balance_sheet : dict):
+@instrumented()
+def liabilities_to_capital_score(statements : FinancialStatements):
     """Returns the score attributed to a company's liabilities to capital ratio."""
-    val = liabilities_to_capital(balance_sheet)
-    return standardized_normal_dist(val, 0.128, 0.45)
+    val = liabilities_to_capital(statements)
+    return ratio_score('liabilities_to_capital', val)
 
-def assets_to_equity_score(balance_sheet : dict):
+@instrumented()
+def assets_to_equity_score(statements : FinancialStatements):
     """Returns the score attributed to a company's assets to equity ratio."""
-    val = assets_to_equity(balance_sheet)
-    return standardized_normal_dist(val, 0.5, 1.5)
+    val = assets_to_equity(statements)
+    return ratio_score('assets_to_equity', val)
 
-def debt_to_ebitda_score(balance_sheet : dict, income_statement : dict):
+@instrumented()
+def debt_to_ebitda_score(statements : FinancialStatements):
     "Returns the score attributed to a company's debt to EBITDA ratio."
-    val = debt_to_ebitda(balance_sheet, income_statement)
-    return standardized_normal_dist(val, 0.425, 1)
+    val = debt_to_ebitda(statements)
+    return ratio_score('debt_to_ebitda', val)
 
-def quick_ratio_score(balance_sheet : dict):
+@instrumented()
+def quick_ratio_score(statements : FinancialStatements):
     """Returns the score attributed to a company's quick ratio."""
-    val = quick_ratio(balance_sheet)
-    return standardized_normal_dist(val, 0.213, 1.0)
+    val = quick_ratio(statements)
+    return ratio_score('quick_ratio', val)
 
-def current_ratio_score(balance_sheet : dict):
+@instrumented()
+def current_ratio_score(statements : FinancialStatements):
     """Returns the score attributed to a company's current ratio."""
-    val = current_ratio(balance_sheet)
-    return standardized_normal_dist(val, 0.213, 1.0)
+    val = current_ratio(statements)
+    return ratio_score('current_ratio', val)
 
-def ten_yr_opex_growth_score(income_statement : dict):
+@instrumented()
+def ten_yr_opex_growth_score(statements : FinancialStatements):
     """Returns the score attributed to a company's 10-year operating expenses growth"""
-    val = ten_yr_operating_expenses_growth(income_statement)
-    return standardized_normal_dist(val, 34, 120)
+    val = ten_yr_operating_expenses_growth(statements)
+    return ratio_score('ten_yr_opex_growth', val)
 
-def ten_yr_assets_growth_score(balance_sheet : dict):
+@instrumented()
+def ten_yr_assets_growth_score(statements : FinancialStatements):
     """Returns the score attributed to a company's 10-year assets growth"""
-    val = ten_yr_assets_growth(balance_sheet)
-    return standardized_normal_dist(val, 64, 125)
+    val = ten_yr_assets_growth(statements)
+    return ratio_score('ten_yr_assets_growth', val)
 
-def ten_yr_liabilities_growth_score(balance_sheet : dict):
+@instrumented()
+def ten_yr_liabilities_growth_score(statements : FinancialStatements):
     """Returns the score attributed to a company's 10-year liabilities growth"""
-    val = ten_yr_liabilities_growth(balance_sheet)
-    return standardized_normal_dist(val, 47, 95)
+    val = ten_yr_liabilities_growth(statements)
+    return ratio_score('ten_yr_liabilities_growth', val)
 
-def ten_yr_share_count_growth_score(cash_flow : dict):
+@instrumented()
+def ten_yr_cash_flow_growth_score(statements : FinancialStatements):
     """Returns the score attributed to a company's 10-year cash flow growth"""
-    val = ten_yr_cash_flow_growth(cash_flow)
-    return standardized_normal_dist(val, 8.5, 10)
+    val = ten_yr_cash_flow_growth(statements)
+    return ratio_score('ten_yr_cash_flow_growth', val)
 
-def ten_yr_share_count_growth_score(balance_sheet : dict):
+@instrumented()
+def ten_yr_share_count_growth_score(statements : FinancialStatements):
     """Returns the score attributed to a company's 10-year share count growth"""
-    val = ten_yr_share_count_growth(balance_sheet)
-    return standardized_normal_dist(val, 8.5, 10)
\ No newline at end of file
+    val = ten_yr_share_count_growth(statements)
+    return ratio_score('ten_yr_share_count_growth', val)
+
+def ratio_matrix(rows : list):
+    """Converts a list of ratio rows (one per company, one value per metric) into a
+       float array, replacing the False of failed ratios with NaN."""
+    return np.array([[np.nan if val is False or val is None else val for val in row] for row in rows], dtype=float)
+
+def params_table(metrics : list, sectors : list = None):
+    """Returns the (standard deviations, means) arrays of a list of metrics, in the
+       order of the list. If the sectors of the companies are given (None for unknown
+       ones), the arrays are (companies x metrics), with the parameters of each
+       company's sector."""
+    if sectors is None:
+        table = np.array([distribution_params[metric] for metric in metrics], dtype=float).reshape(-1, 2)
+        return table[:, 0], table[:, 1]
+
+    table = np.array([[sector_params.get(sector, {}).get(metric, distribution_params[metric]) for metric in metrics]
+                      for sector in sectors], dtype=float).reshape(len(sectors), len(metrics), 2)
+    return table[..., 0], table[..., 1]
+
+def score_matrix(ratios : np.ndarray, stds : np.ndarray, means : np.ndarray):
+    """Vectorized standardized_normal_dist. Scores a (companies x metrics) array of
+       ratios, each column on its own distribution. NaN ratios give NaN scores."""
+    return np.exp(-(ratios - means)**2 / (2 * stds**2))
+
+def average_scores(scores : np.ndarray):
+    """Returns the average score of each row of a score array (along its last axis),
+       leaving NaN scores out of the average. Rows without any score average to NaN."""
+    mask = ~np.isnan(scores)
+    counts = mask.sum(axis=-1)
+    totals = np.where(mask, scores, 0).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(counts > 0, totals / counts, np.nan)
+
+@instrumented()
+def score_universe(ratios : np.ndarray, metrics : list, extra_scores : np.ndarray = None, sectors : list = None):
+    """Scores a (companies x metrics) array of ratios, metrics naming its columns, and
+       returns the score array along with the average score of every company. Scores
+       that are already calculated (e.g. the qualitative ones) can be passed as
+       extra_scores, a (companies x n) array appended to the scores before averaging.
+       With the sector of every company, each is scored on its sector's parameters."""
+    stds, means = params_table(metrics, sectors if sector_params else None)
+    scores = score_matrix(ratios, stds, means)
+
+    if extra_scores is not None:
+        scores = np.hstack([scores, extra_scores])
+
+    return scores, average_scores(scores)
@@ -0,0 +1,198 @@
+# The code in this file ingests the financial statements of the whole US market at once
+# from the SEC's XBRL "companyfacts" archive, instead of fetching them ticker by ticker
+# from AlphaVantage. The archive (https://www.sec.gov/Archives/edgar/daily-index/xbrl/companyfacts.zip)
+# holds one JSON file per company with every fact it ever reported in its filings, and
+# the SEC's ticker list (https://www.sec.gov/files/company_tickers.json) maps tickers
+# to the companies' CIK numbers. Both are downloaded once and read locally.
+# The archive is read one company at a time, so memory use stays bounded by the
+# largest company rather than the whole market. The annual (10-K) facts of each
+# company are mapped to the AlphaVantage fields HedgeHog uses and laid out in the same
+# 'annualReports' shape as the AlphaVantage responses, then written to the statement
+# cache. From there, FinancialStatements.from_reports and the ratio functions of
+# quant.py (and the backtest) use them like statements fetched from AlphaVantage.
+
+import json
+import zipfile
+import argparse
+from datetime import date
+from quant import statement_cache
+from tickers import load_sec_tickers
+from metrics import metrics, instrumented
+
+# Forms annual reports are filed with
+annual_forms = ('10-K', '10-K/A', '20-F', '20-F/A', '40-F', '40-F/A')
+
+# XBRL concepts read for each AlphaVantage field, as {AlphaVantage field: concepts}.
+# Companies don't all tag the same items with the same concepts, so the first concept
+# a company reported a fiscal year with is used.
+balance_sheet_concepts = {
+    'totalAssets': ('Assets',),
+    'totalLiabilities': ('Liabilities',),
+    'totalShareholderEquity': ('StockholdersEquity', 'StockholdersEquityIncludingPortionAttributableToNoncontrollingInterest'),
+    'cashAndCashEquivalentsAtCarryingValue': ('CashAndCashEquivalentsAtCarryingValue', 'Cash'),
+    'totalCurrentAssets': ('AssetsCurrent',),
+    'currentNetReceivables': ('AccountsReceivableNetCurrent', 'ReceivablesNetCurrent'),
+    'totalCurrentLiabilities': ('LiabilitiesCurrent',),
+    'commonStock': ('CommonStockValue', 'CommonStocksIncludingAdditionalPaidInCapital'),
+    'commonStockSharesOutstanding': ('CommonStockSharesOutstanding',),
+}
+
+income_statement_concepts = {
+    'totalRevenue': ('Revenues', 'RevenueFromContractWithCustomerExcludingAssessedTax', 'SalesRevenueNet'),
+    'operatingExpenses': ('OperatingExpenses', 'CostsAndExpenses'),
+    'operatingIncome': ('OperatingIncomeLoss',),
+    'depreciationAndAmortization': ('DepreciationDepletionAndAmortization', 'DepreciationAndAmortization',
+                                    'DepreciationAmortizationAndAccretionNet'),
+    'netIncome': ('NetIncomeLoss',),
+}
+
+cash_flow_concepts = {
+    'operatingCashflow': ('NetCashProvidedByUsedInOperatingActivities',),
+}
+
+# Statements built from the archive, as (AlphaVantage function, concepts, whether the
+# facts cover a period, like income, rather than an instant, like a balance)
+sec_statements = (
+    ('BALANCE_SHEET', balance_sheet_concepts, False),
+    ('INCOME_STATEMENT', income_statement_concepts, True),
+    ('CASH_FLOW', cash_flow_concepts, True),
+)
+
+def is_annual_fact(fact : dict, period : bool):
+    """Checks that a fact comes from an annual report and, for period facts, that it
+       covers a whole fiscal year rather than a quarter."""
+    if fact.get('form') not in annual_forms or fact.get('fp') != 'FY':
+        return False
+
+    if not period:
+        return 'start' not in fact
+
+    if 'start' not in fact:
+        return False
+
+    days = (date.fromisoformat(fact['end']) - date.fromisoformat(fact['start'])).days
+    return 350 <= days <= 380
+
+def annual_values(facts : dict, concepts : tuple, period : bool):
+    """Returns the annual values of a field as {fiscal year end: value}, from the
+       first of its concepts reported for each year. When a year is reported in
+       several filings (as comparatives in the following ones, or restated), the
+       value of the latest filing is kept."""
+    values = {}
+
+    for concept in concepts:
+        units = facts.get(concept, {}).get('units', {})
+        found = {}
+
+        for fact in units.get('USD') or units.get('shares') or []:
+            if is_annual_fact(fact, period) and fact['end'] not in values:
+                if fact['end'] not in found or fact['filed'] >= found[fact['end']][0]:
+                    found[fact['end']] = (fact['filed'], fact['val'])
+
+        values.update({end: value for end, (_, value) in found.items()})
+
+    return values
+
+def format_value(value : float):
+    """Formats a value the way AlphaVantage reports them."""
+    if value is None:
+        return 'None'
+    return str(int(value)) if float(value).is_integer() else str(value)
+
+def company_statements(company_facts : dict, symbol : str):
+    """Builds the BALANCE_SHEET, INCOME_STATEMENT and CASH_FLOW responses of a company
+       from its companyfacts JSON, in the shape AlphaVantage returns them. Returns
+       them as {function: response}, empty if the company has no annual balance sheet."""
+    facts = company_facts.get('facts', {}).get('us-gaap', {})
+
+    columns = {}
+    for function, concepts, period in sec_statements:
+        columns[function] = {field: annual_values(facts, field_concepts, period)
+                             for field, field_concepts in concepts.items()}
+
+    # Fiscal years are the ones the company reported its total assets for
+    fiscal_ends = sorted(columns['BALANCE_SHEET']['totalAssets'], reverse=True)
+    if not fiscal_ends:
+        return {}
+
+    balance_sheet = columns['BALANCE_SHEET']
+    income_statement = columns['INCOME_STATEMENT']
+
+    # Derived when not reported directly
+    balance_sheet['totalLiabilities'] = {**{end: value - balance_sheet['totalShareholderEquity'][end]
+                                            for end, value in annual_values(facts, ('LiabilitiesAndStockholdersEquity',), False).items()
+                                            if end in balance_sheet['totalShareholderEquity']},
+                                         **balance_sheet['totalLiabilities']}
+    income_statement['ebitda'] = {end: value + income_statement['depreciationAndAmortization'][end]
+                                  for end, value in income_statement['operatingIncome'].items()
+                                  if end in income_statement['depreciationAndAmortization']}
+
+    responses = {}
+    for function, fields in columns.items():
+        reports = [{'fiscalDateEnding': end, 'reportedCurrency': 'USD',
+                    **{field: format_value(values.get(end)) for field, values in fields.items()}}
+                   for end in fiscal_ends]
+        responses[function] = {'symbol': symbol, 'annualReports': reports}
+
+    return responses
+
+def iter_companyfacts(archive_path : str, ciks : set = None):
+    """Yields (CIK, companyfacts JSON) for every company of the archive, or only for
+       the given CIKs. The archive is read one company at a time."""
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            name = member.filename.rsplit('/', 1)[-1]
+            if not (name.startswith('CIK') and name.endswith('.json')):
+                continue
+
+            cik = int(name[3:-5])
+            if ciks is not None and cik not in ciks:
+                continue
+
+            with archive.open(member) as member_file:
+                yield cik, json.load(member_file)
+
+@instrumented(ticker_arg=None)
+def ingest_companyfacts(archive_path : str, tickers_path : str = 'company_tickers.json', universe : list = None,
+                        cache = None):
+    """Writes the statements of every listed company of a companyfacts archive (or of
+       the companies of universe only) to the statement cache, under their tickers.
+       Returns the tickers ingested and the ones with no usable annual report."""
+    cache = statement_cache if cache is None else cache
+    universe = None if universe is None else set(universe)
+
+    tickers_of = {}
+    for ticker, cik in load_sec_tickers(tickers_path).items():
+        if universe is None or ticker in universe:
+            tickers_of.setdefault(cik, []).append(ticker)
+
+    ingested = []
+    skipped = []
+
+    for cik, company_facts in iter_companyfacts(archive_path, set(tickers_of)):
+        # Share classes (like GOOG and GOOGL) file together, under the same CIK
+        for ticker in tickers_of[cik]:
+            responses = company_statements(company_facts, ticker)
+            if not responses:
+                skipped.append(ticker)
+                continue
+
+            for function, response in responses.items():
+                cache.store(ticker, function, response)
+            metrics.count('sec_companies_ingested', ticker)
+            ingested.append(ticker)
+
+    return ingested, skipped
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Ingests the statements of the SEC companyfacts archive into the statement cache.')
+    parser.add_argument('archive', help='companyfacts.zip archive downloaded from the SEC')
+    parser.add_argument('--tickers-file', default='company_tickers.json', help="the SEC's company_tickers.json")
+    parser.add_argument('--tickers', nargs='+', help='only ingest these tickers (every listed company by default)')
+    args = parser.parse_args()
+
+    ingested, skipped = ingest_companyfacts(args.archive, args.tickers_file, args.tickers)
+
+    print(f'Ingested the statements of {len(ingested)} companies into "{statement_cache.directory}"')
+    if skipped:
+        print(f'{len(skipped)} companies had no usable annual report: {", ".join(skipped[:20])}{"..." if len(skipped) > 20 else ""}')
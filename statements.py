@@ -0,0 +1,111 @@
+# The code in this file turns the raw AlphaVantage JSON statements of a company into
+# a compact FinancialStatements object. The string values of the reports are parsed
+# once into NumPy arrays (one per field, indexed by fiscal year, most recent first,
+# like the 'annualReports' lists), with NaN wherever AlphaVantage reports "None". The
+# ratio functions of quant.py then work on these preparsed columns instead of digging
+# into the JSON dictionaries and converting the same strings again and again.
+# UniversePanel lays out the statements of a whole universe the same way, with one
+# (tickers x fiscal years) array per field, for cross-sectional work.
+
+import numpy as np
+
+# Fields read from each statement, as {attribute name: AlphaVantage field name}
+balance_sheet_fields = {
+    'total_liabilities': 'totalLiabilities',
+    'total_shareholder_equity': 'totalShareholderEquity',
+    'total_assets': 'totalAssets',
+    'cash_and_equivalents': 'cashAndCashEquivalentsAtCarryingValue',
+    'total_current_assets': 'totalCurrentAssets',
+    'current_net_receivables': 'currentNetReceivables',
+    'total_current_liabilities': 'totalCurrentLiabilities',
+    'common_stock': 'commonStock',
+}
+
+income_statement_fields = {
+    'ebitda': 'ebitda',
+    'operating_expenses': 'operatingExpenses',
+}
+
+cash_flow_fields = {
+    'operating_cashflow': 'operatingCashflow',
+}
+
+all_fields = {**balance_sheet_fields, **income_statement_fields, **cash_flow_fields}
+
+def parse_value(value):
+    """Converts an AlphaVantage report value to a float, NaN if it is missing."""
+    if value is None or value == 'None' or value == '':
+        return np.nan
+    return float(value)
+
+class FinancialStatements:
+    """Annual financial statements of a company, stored as one float array per field.
+       Index 0 is the most recent fiscal year and every array has the same length as
+       fiscal_dates, so fields coming from different statements line up by year."""
+
+    __slots__ = ('ticker', 'fiscal_dates', *all_fields)
+
+    def __init__(self, ticker : str, fiscal_dates : list, columns : dict):
+        self.ticker = ticker
+        self.fiscal_dates = fiscal_dates
+        for field in all_fields:
+            setattr(self, field, columns.get(field, np.full(len(fiscal_dates), np.nan)))
+
+    def __len__(self):
+        return len(self.fiscal_dates)
+
+    @classmethod
+    def from_reports(cls, balance_sheet : dict, income_statement : dict = None, cash_flow : dict = None):
+        """Builds the object from the parsed JSON responses of get_balance_sheet,
+           get_income_statement and get_cash_flow. Only the balance sheet is required."""
+
+        statements = [(balance_sheet, balance_sheet_fields),
+                      (income_statement, income_statement_fields),
+                      (cash_flow, cash_flow_fields)]
+        statements = [(statement, fields) for statement, fields in statements if statement is not None]
+
+        fiscal_dates = sorted({report['fiscalDateEnding'] for statement, _ in statements
+                               for report in statement['annualReports']}, reverse=True)
+        year_index = {fiscal_date: index for index, fiscal_date in enumerate(fiscal_dates)}
+
+        columns = {}
+        for statement, fields in statements:
+            rows = [year_index[report['fiscalDateEnding']] for report in statement['annualReports']]
+            for field, av_field in fields.items():
+                column = np.full(len(fiscal_dates), np.nan)
+                column[rows] = [parse_value(report.get(av_field)) for report in statement['annualReports']]
+                columns[field] = column
+
+        return cls(balance_sheet.get('symbol'), fiscal_dates, columns)
+
+class UniversePanel:
+    """Statements of a whole universe, with one (tickers x fiscal years) float array per
+       field. Column j holds fiscal year years[j], most recent first and with no gaps,
+       so the column functions of quant.py work on it like on a FinancialStatements."""
+
+    __slots__ = ('tickers', 'years', 'fiscal_ends', *all_fields)
+
+    @classmethod
+    def from_statements(cls, statements_list : list):
+        """Lays out a list of FinancialStatements in a panel. Reports are placed in the
+           column of the calendar year their fiscal year ends in."""
+        panel = cls()
+        panel.tickers = [statements.ticker for statements in statements_list]
+
+        fiscal_years = [int(fiscal_date[:4]) for statements in statements_list for fiscal_date in statements.fiscal_dates]
+        last_year = max(fiscal_years, default=0)
+        first_year = min(fiscal_years, default=1)
+        panel.years = np.arange(last_year, first_year - 1, -1)
+
+        shape = (len(panel.tickers), len(panel.years))
+        panel.fiscal_ends = np.full(shape, np.datetime64('NaT'), dtype='datetime64[D]')
+        for field in all_fields:
+            setattr(panel, field, np.full(shape, np.nan))
+
+        for row, statements in enumerate(statements_list):
+            columns = [last_year - int(fiscal_date[:4]) for fiscal_date in statements.fiscal_dates]
+            panel.fiscal_ends[row, columns] = np.array(statements.fiscal_dates, dtype='datetime64[D]')
+            for field in all_fields:
+                getattr(panel, field)[row, columns] = getattr(statements, field)
+
+        return panel
@@ -0,0 +1,176 @@
+# The code in this file keeps the fundamentals of the whole universe on disk in a
+# columnar layout, so that cross-sectional work (universe statistics, rescoring,
+# backtests) doesn't need to load and parse thousands of JSON responses. Every field
+# of FinancialStatements is stored in its own .npy file as a (tickers x fiscal years)
+# float array, laid out like a UniversePanel (see statements.py), next to an index
+# file holding the tickers and years of the rows and columns. The files are read
+# memory-mapped, so loading the store is nearly instant and only the parts of the
+# arrays actually used are read from the disk, and the ratio column functions of
+# quant.py read them directly, without copies.
+# New companies are appended in place: the arrays have room for more rows than there
+# are tickers, and the new rows are only counted once the index is written. The
+# arrays are rewritten when they run out of rows, when a new fiscal year comes in, or
+# when companies already in the store are updated, since their rows are in use. A
+# rewrite writes a new generation of the arrays next to the current one, which the
+# index keeps pointing to until the new generation is complete: a crash partway
+# through leaves the store as it was, and the old generation is only deleted once the
+# index has switched over.
+
+import os
+import json
+import numpy as np
+from cache import atomic_write_json
+from statements import FinancialStatements, UniversePanel, all_fields
+from metrics import instrumented
+
+# Arrays of the store, as {name: (dtype, missing value)}
+store_arrays = {'fiscal_ends': ('datetime64[D]', np.datetime64('NaT')),
+                **{field: ('float64', np.nan) for field in all_fields}}
+
+class FundamentalsStore:
+    """Columnar, memory-mapped store of the annual statements of a universe."""
+
+    def __init__(self, directory : str = 'store'):
+        self.directory = directory
+
+        try:
+            with open(self.path('index.json')) as index_file:
+                index = json.load(index_file)
+        except FileNotFoundError:
+            index = {'tickers': [], 'years': [], 'capacity': 0}
+
+        self.tickers = index['tickers']
+        self.years = index['years']
+        self.capacity = index['capacity']
+        self.generation = index.get('generation', 0)
+        # Generation replaced by a rewrite, deleted once the index points to the new one
+        self.stale_generation = None
+        self.rows = {ticker: row for row, ticker in enumerate(self.tickers)}
+
+    def __len__(self):
+        return len(self.tickers)
+
+    def __contains__(self, ticker : str):
+        return ticker in self.rows
+
+    def path(self, name : str):
+        """Returns the path of a file of the store."""
+        return os.path.join(self.directory, name)
+
+    def array_path(self, name : str, generation : int = None):
+        """Returns the path of one of the arrays of a generation (the current one by default)."""
+        generation = self.generation if generation is None else generation
+        return self.path(f'{name}.npy' if generation == 0 else f'{name}.{generation}.npy')
+
+    def array(self, name : str, mode : str = 'r'):
+        """Memory-maps one of the arrays of the store, with room for capacity rows."""
+        return np.load(self.array_path(name), mmap_mode=mode)
+
+    def panel(self):
+        """Returns the whole store as a UniversePanel whose arrays are read-only views
+           of the memory-mapped files."""
+        panel = UniversePanel()
+        panel.tickers = list(self.tickers)
+        panel.years = np.array(self.years, dtype=int)
+
+        for name in store_arrays:
+            if self.capacity:
+                setattr(panel, name, self.array(name)[:len(self.tickers)])
+            else:
+                dtype, missing = store_arrays[name]
+                setattr(panel, name, np.full((0, 0), missing, dtype=dtype))
+
+        return panel
+
+    def write_index(self):
+        """Writes the index last, so that rows appended or arrays rewritten before a
+           crash are ignored, then deletes the generation a rewrite replaced."""
+        atomic_write_json(self.path('index.json'), {'tickers': self.tickers, 'years': self.years, 'capacity': self.capacity,
+                                                    'generation': self.generation})
+
+        if self.stale_generation is not None:
+            for name in store_arrays:
+                try:
+                    os.remove(self.array_path(name, self.stale_generation))
+                except FileNotFoundError:
+                    pass
+
+            self.stale_generation = None
+
+    def rewrite(self, years : list, capacity : int):
+        """Rewrites every array with new fiscal years (most recent first) and room for
+           capacity rows, moving the existing rows over. The arrays are written as a new
+           generation, which only replaces the current one when the index is written."""
+        os.makedirs(self.directory, exist_ok=True)
+        generation = self.generation + 1
+
+        for name, (dtype, missing) in store_arrays.items():
+            values = np.full((capacity, len(years)), missing, dtype=dtype)
+
+            if self.capacity and self.years:
+                old = self.array(name)
+                offset = years.index(self.years[0])
+                values[:len(self.tickers), offset:offset + len(self.years)] = old[:len(self.tickers)]
+                del old
+
+            np.save(self.array_path(name, generation), values)
+
+        if self.capacity:
+            self.stale_generation = self.generation
+
+        self.generation = generation
+        self.years = years
+        self.capacity = capacity
+
+    @instrumented('store_append')
+    def append(self, statements_list : list):
+        """Adds the statements of companies to the store, or replaces them for the
+           companies already in it. The statements are FinancialStatements, as built
+           from the quant.get_* responses by FinancialStatements.from_reports."""
+        statements_list = [statements for statements in statements_list if len(statements)]
+        if not statements_list:
+            return
+
+        fiscal_years = [int(fiscal_date[:4]) for statements in statements_list for fiscal_date in statements.fiscal_dates]
+        last_year = max(fiscal_years + self.years[:1])
+        first_year = min(fiscal_years + self.years[-1:])
+        years = list(range(last_year, first_year - 1, -1))
+
+        new_tickers = [statements.ticker for statements in statements_list if statements.ticker not in self.rows]
+        needed = len(self.tickers) + len(set(new_tickers))
+        updated = len(new_tickers) < len(statements_list)
+
+        # Grows the arrays geometrically, so that appending stays cheap on average. Rows
+        # in use are never written to in place
+        if years != self.years or needed > self.capacity or updated:
+            self.rewrite(years, max(needed, 2 * self.capacity) if needed > self.capacity else self.capacity)
+
+        for ticker in new_tickers:
+            if ticker not in self.rows:
+                self.rows[ticker] = len(self.tickers)
+                self.tickers.append(ticker)
+
+        rows = [self.rows[statements.ticker] for statements in statements_list]
+
+        for name, (dtype, missing) in store_arrays.items():
+            array = self.array(name, 'r+')
+            array[rows] = missing
+
+            for row, statements in zip(rows, statements_list):
+                columns = [last_year - int(fiscal_date[:4]) for fiscal_date in statements.fiscal_dates]
+                if name == 'fiscal_ends':
+                    array[row, columns] = np.array(statements.fiscal_dates, dtype=dtype)
+                else:
+                    array[row, columns] = getattr(statements, name)
+
+            array.flush()
+            del array
+
+        self.write_index()
+
+    def add_reports(self, ticker : str, balance_sheet : dict, income_statement : dict = None, cash_flow : dict = None):
+        """Adds a company to the store from its get_balance_sheet, get_income_statement
+           and get_cash_flow responses."""
+        statements = FinancialStatements.from_reports(balance_sheet, income_statement, cash_flow)
+        statements.ticker = ticker
+        self.append([statements])
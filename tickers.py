@@ -1,4 +1,9 @@
-# This is a list of tickers in the S&P500. This list was made on Feb. 1 2025
+# This is a list of tickers in the S&P500. This list was made on Feb. 1 2025. For the
+# whole US market, load_sec_tickers reads the SEC's list of every listed company
+# instead of a list maintained by hand.
+
+import json
+
 sp500 = ['AAPL', 'MSFT', 'NVDA', 'GOOG', 'AMZN', 'GOOGL', 'META', 'TSLA', 'AVGO', 
         'BRK.B', 'WMT', 'JPM', 'LLY', 'V', 'MA', 'UNH', 'ORCL', 'XOM', 'COST', 
         'NFLX', 'HD', 'PG', 'JNJ', 'BAC', 'CRM', 'ABBV', 'KO', 'CVX', 'TMUS', 'WFC',
@@ -47,4 +52,19 @@ sp500 = ['AAPL', 'MSFT', 'NVDA', 'GOOG', 'AMZN', 'GOOGL', 'META', 'TSLA', 'AVGO'
         'CPB', 'JNPR', 'ALLE', 'EMN', 'SJM', 'TAP', 'DAY', 'AIZ', 'IPG', 'BG', 'MGM', 
         'GL', 'HSIC', 'ALB', 'PNW', 'AOS', 'LKQ', 'WYNN', 'FRT', 'MTCH', 'GNRC', 'WBA', 
         'MOS', 'IVZ', 'LW', 'CRL', 'ENPH', 'TFX', 'MKTX', 'APA', 'HAS', 'AES', 'CE', 
-        'MHK', 'HII', 'CZR', 'PARA', 'BWA', 'FMC']
\ No newline at end of file
+        'MHK', 'HII', 'CZR', 'PARA', 'BWA', 'FMC']
+
+# The 11 GICS sectors. Every ticker of the universe is mapped to one of these by the
+# qualitative analysis, so that sector sentiment only needs to be analysed once per sector
+gics_sectors = ['Communication Services', 'Consumer Discretionary', 'Consumer Staples',
+                'Energy', 'Financials', 'Health Care', 'Industrials', 'Information Technology',
+                'Materials', 'Real Estate', 'Utilities']
+
+def load_sec_tickers(path : str = 'company_tickers.json'):
+    """Reads the SEC's list of listed companies (https://www.sec.gov/files/company_tickers.json)
+       and returns it as {ticker: CIK}. Share class tickers are written with a dot, like
+       BRK.B, as AlphaVantage expects them, rather than the SEC's dash."""
+    with open(path) as tickers_file:
+        companies = json.load(tickers_file)
+
+    return {company['ticker'].replace('-', '.'): int(company['cik_str']) for company in companies.values()}